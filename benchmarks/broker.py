@@ -0,0 +1,140 @@
+# Load test of `pyvault serve` as a fleet broker.
+#
+#   python -m benchmarks.broker --nodes 60 --profiles 5 --requests 20
+#
+# One broker (in-process, against the local fake STS) serves simulated CI nodes, each a thread with
+# a token cache of its own. Every profile must cost exactly one AssumeRole however many nodes ask
+# for it at once, and a node must fall back to its local copy once the broker is gone.
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from benchmarks.fakes import FakeSts
+from benchmarks.resolution import write_home
+from vault.version import version as ver
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def start_server(unix, home):
+    from vault.aws.auth import Auth
+    from vault.aws.clients import ClientFactory
+    from vault.aws.server import CredentialServer, CredentialService, UnixCredentialServer
+
+    # Clients of its own: pooled STS clients would still point at the previous run's fake endpoint.
+    clients = ClientFactory()
+    service = CredentialService(config_path=os.path.join(home, ".aws", "config"),
+                                auth_factory=lambda profile: Auth(profile, background=True, clients=clients))
+    if unix:
+        server = UnixCredentialServer(service, os.path.join(home, "broker.sock"))
+    else:
+        server = CredentialServer(service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def scenario(nodes, profiles, requests, unix):
+    from vault.aws.broker import BrokerAuth, BrokerClient
+    from vault.aws.cfg import AwsTokens
+    from vault.aws.tokens import FileTokenStore
+
+    home = write_home(tempfile.mkdtemp(prefix="pyvault-broker-"), profiles=profiles)
+    old_home, os.environ["HOME"] = os.environ.get("HOME"), home
+    names = [f"bench{i}" for i in range(profiles)]
+    try:
+        with FakeSts(latency=0.2) as sts:
+            os.environ["AWS_ENDPOINT_URL_STS"] = sts.url
+            server = start_server(unix, home)
+            client = BrokerClient(server.url, server.token)
+            stores = [FileTokenStore(os.path.join(home, "nodes", str(n), "tokens.d")) for n in range(nodes)]
+
+            def node_auth(args):
+                node, name = args
+                started = time.perf_counter()
+                BrokerAuth(name, client, tokens=AwsTokens(name, store=stores[node])).auth()
+                return (time.perf_counter() - started) * 1000
+
+            # Every node asks for every profile at the same time: the broker has to coalesce.
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=nodes) as pool:
+                first = list(pool.map(node_auth, [(n, name) for n in range(nodes) for name in names]))
+            burst_ms = (time.perf_counter() - started) * 1000
+            calls = len(sts.calls)
+
+            # Then the broker's steady state: cache hits over the wire, no local cache involved.
+            def fetch(i):
+                started = time.perf_counter()
+                client.fetch(names[i % len(names)])
+                return (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=nodes) as pool:
+                hits = list(pool.map(fetch, range(nodes * requests)))
+            wall = time.perf_counter() - started
+
+            server.shutdown()
+            server.server_close()
+            fallback_ok = BrokerAuth(names[0], client, tokens=AwsTokens(names[0], store=stores[0])).auth() is not None
+            try:
+                empty = FileTokenStore(os.path.join(home, "nodes", "empty", "tokens.d"))
+                BrokerAuth(names[0], client, tokens=AwsTokens(names[0], store=empty)).auth()
+                no_cache_fails = False
+            except ValueError:
+                no_cache_fails = True
+    finally:
+        os.environ.pop("AWS_ENDPOINT_URL_STS", None)
+        os.environ["HOME"] = old_home
+        shutil.rmtree(home)
+
+    return {
+        "transport": "unix" if unix else "tcp",
+        "nodes": nodes,
+        "profiles": profiles,
+        "burst_ms": round(burst_ms, 2),
+        "burst_p99_ms": round(percentile(first, 99), 2),
+        "backend_calls": calls,
+        "requests": len(hits),
+        "requests_per_s": round(len(hits) / wall, 1),
+        "hit_p50_ms": round(statistics.median(hits), 2),
+        "hit_p99_ms": round(percentile(hits, 99), 2),
+        "fallback_ok": fallback_ok and no_cache_fails,
+        "ok": calls == profiles and fallback_ok and no_cache_fails
+    }
+
+
+@click.command()
+@click.option("--nodes", help="Simulated clients", default=60, type=int)
+@click.option("--profiles", help="Deploy roles they all ask for", default=5, type=int)
+@click.option("--requests", help="Requests per node in the steady-state run", default=20, type=int)
+@click.option("--output", help="Write the JSON report here instead of stdout", type=click.Path())
+def main(nodes, profiles, requests, output):
+    results = {
+        "tcp": scenario(nodes, profiles, requests, unix=False),
+        "unix": scenario(nodes, profiles, requests, unix=True)
+    }
+    text = json.dumps({"pyvault": ver, "python": sys.version.split()[0], "timestamp": int(time.time()),
+                       "results": results}, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        click.echo(text)
+    failed = [name for name, result in results.items() if not result["ok"]]
+    if failed:
+        click.secho(f"Failed: {', '.join(failed)}", fg="red", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+ASSUME_ROLE_RESPONSE = """<AssumeRoleResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">
+  <AssumeRoleResult>
+    <Credentials>
+      <AccessKeyId>{key}</AccessKeyId>
+      <SecretAccessKey>secret</SecretAccessKey>
+      <SessionToken>token-{key}</SessionToken>
+      <Expiration>{expiration}</Expiration>
+    </Credentials>
+    <AssumedRoleUser>
+      <Arn>{arn}</Arn>
+      <AssumedRoleId>AROAFAKE:AssumeRoleSession</AssumedRoleId>
+    </AssumedRoleUser>
+  </AssumeRoleResult>
+  <ResponseMetadata>
+    <RequestId>{calls}</RequestId>
+  </ResponseMetadata>
+</AssumeRoleResponse>
+"""
+
+
+class FakeStsHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        params = {k: v[0] for k, v in parse_qs(body).items()}
+        calls = self.server.record(params)
+        time.sleep(self.server.latency)
+        expiration = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.server.clock() + self.server.ttl))
+        payload = ASSUME_ROLE_RESPONSE.format(key=f"ASIAFAKE{calls:012d}", expiration=expiration,
+                                              arn=params.get("RoleArn", ""), calls=calls).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSts(ThreadingHTTPServer):
+    # A local stand-in for the STS query API, only AssumeRole is answered. Point botocore at it
+    # with AWS_ENDPOINT_URL_STS.
+    daemon_threads = True
+
+    def __init__(self, latency=0.05, ttl=3600, clock=time.time):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeStsHandler)
+        self.latency = latency
+        self.ttl = ttl
+        # Expirations are stamped from this clock, so simulations can run on a fake one.
+        self.clock = clock
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def record(self, params):
+        with self.lock:
+            self.calls.append(params)
+            return len(self.calls)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,127 @@
+# Simulated working day of the pre-warming scheduler, on a fake clock against the local fake STS.
+#
+#   python -m benchmarks.prewarm --hot 5 --cold 20 --hours 8
+#
+# Hot profiles are used in bursts with gaps longer than a session, cold ones a couple of times.
+# The same day is replayed with and without the scheduler: a command waits for STS when it finds
+# no usable token. With the scheduler, no profile may wait once it is hot, and cold profiles must
+# never be renewed by it.
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import click
+
+from benchmarks.fakes import FakeSts
+from benchmarks.resolution import write_home
+from vault.version import version as ver
+
+
+def schedule(hot, cold, hours, seed):
+    rng = random.Random(seed)
+    uses = []
+    for i in range(hot):
+        t = rng.uniform(0, 1800)
+        while t < hours * 3600:
+            uses += [(t + k * rng.uniform(30, 300), f"bench{i}") for k in range(rng.randint(1, 4))]
+            t += rng.expovariate(1 / 3600)
+    for i in range(hot, hot + cold):
+        uses += [(rng.uniform(0, hours * 3600), f"bench{i}") for _ in range(2)]
+    return sorted(uses)
+
+
+def day(uses, hot, cold, prewarm):
+    from vault.aws import tokens
+    from vault.aws.auth import EXPIRY_SKEW, Auth
+    from vault.aws.cfg import AwsConfigReader
+    from vault.aws.clients import ClientFactory
+    from vault.aws.prewarm import PREWARM_MIN_USES, PREWARM_WINDOW, Prewarmer
+
+    home = write_home(tempfile.mkdtemp(prefix="pyvault-prewarm-"), profiles=hot + cold)
+    old_home, os.environ["HOME"] = os.environ.get("HOME"), home
+    tokens.stores.clear()
+    start = time.time()
+    now = [start]
+    try:
+        with FakeSts(latency=0, clock=lambda: now[0]) as sts:
+            os.environ["AWS_ENDPOINT_URL_STS"] = sts.url
+            clients = ClientFactory()
+            reader = AwsConfigReader()
+            store = tokens.token_store()
+            scheduler = Prewarmer(reader, clock=lambda: now[0], clients=clients)
+            cold_names = {f"bench{i}" for i in range(hot, hot + cold)}
+            waited = {"hot": 0, "cold": 0, "when_hot": 0}
+            history = {}
+            prewarmed_cold = 0
+            next_run = start
+
+            for offset, name in uses:
+                while prewarm and next_run <= start + offset:
+                    now[0] = next_run
+                    results, wait = scheduler.run_once()
+                    prewarmed_cold += len([n for n, status in results.items() if n in cold_names and status == "renewed"])
+                    next_run += max(wait, 1)
+                now[0] = start + offset
+                auth = Auth(reader[name], clients=clients)
+                token = store.get(name)
+                left = float(token['expiration']) - now[0] if token else 0
+                used = history.setdefault(name, [])
+                if left < EXPIRY_SKEW:
+                    waited["cold" if name in cold_names else "hot"] += 1
+                    waited["when_hot"] += len([t for t in used if t >= now[0] - PREWARM_WINDOW]) >= PREWARM_MIN_USES
+                    auth.renew()
+                    store.stats.record(name, "miss", now=now[0])
+                else:
+                    if left < auth.refresh_window:
+                        # What refresh-ahead would have done in the background.
+                        auth.renew()
+                    store.stats.record(name, "hit", now=now[0])
+                used.append(now[0])
+            calls = len(sts.calls)
+    finally:
+        os.environ.pop("AWS_ENDPOINT_URL_STS", None)
+        os.environ["HOME"] = old_home
+        tokens.stores.clear()
+        shutil.rmtree(home)
+
+    return {
+        "commands": len(uses),
+        "hot_waited": waited["hot"],
+        "waited_when_hot": waited["when_hot"],
+        "cold_waited": waited["cold"],
+        "sts_calls": calls,
+        "cold_prewarmed": prewarmed_cold
+    }
+
+
+@click.command()
+@click.option("--hot", help="Profiles used throughout the day", default=5, type=int)
+@click.option("--cold", help="Profiles used twice a day", default=20, type=int)
+@click.option("--hours", help="Length of the simulated day", default=8, type=int)
+@click.option("--seed", help="Seed of the usage pattern", default=1, type=int)
+@click.option("--output", help="Write the JSON report here instead of stdout", type=click.Path())
+def main(hot, cold, hours, seed, output):
+    uses = schedule(hot, cold, hours, seed)
+    lazy = day(uses, hot, cold, prewarm=False)
+    prewarmed = day(uses, hot, cold, prewarm=True)
+    # Before a profile has PREWARM_MIN_USES uses there is nothing to predict from.
+    ok = prewarmed["waited_when_hot"] == 0 and prewarmed["cold_prewarmed"] == 0 and \
+        prewarmed["cold_waited"] == lazy["cold_waited"]
+    text = json.dumps({"pyvault": ver, "python": sys.version.split()[0], "timestamp": int(time.time()),
+                       "results": {"lazy": lazy, "prewarm": prewarmed, "ok": ok}}, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        click.echo(text)
+    if not ok:
+        click.secho("Failed: hot profiles waited for STS or cold ones were pre-warmed", fg="red", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
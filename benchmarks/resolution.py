@@ -0,0 +1,255 @@
+# Benchmarks for the credential resolution paths of `pyvault exec`.
+#
+#   python -m benchmarks.resolution --output bench.json
+#
+# Every scenario runs against a throw-away HOME, STS is a local fake endpoint or a botocore Stubber,
+# so nothing here talks to AWS. Results are written as JSON; the process exits non-zero when one of
+# the checked budgets or invariants fails, so it can gate a release.
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from benchmarks.fakes import FakeSts
+from vault.version import version as ver
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Allowed cost of a cache-hit `pyvault exec` on top of a bare interpreter start.
+FAST_PATH_BUDGET_MS = 50
+# Modules that must not be imported on a cache hit.
+HEAVY_MODULES = ("boto3", "botocore", "click", "webbrowser", "requests")
+
+
+def write_home(home, profiles=1):
+    aws = os.path.join(home, ".aws")
+    os.makedirs(aws, exist_ok=True)
+    with open(os.path.join(aws, "config"), "w") as f:
+        f.write("[default]\nregion = eu-west-1\n\n[profile base]\n\n")
+        for i in range(profiles):
+            f.write(f"[profile bench{i}]\nsource_profile = base\nrole_arn = arn:aws:iam::123456789012:role/R{i}\n\n")
+    with open(os.path.join(aws, "credentials"), "w") as f:
+        f.write("[base]\naws_access_key_id = AKIAFAKEBASE\naws_secret_access_key = secret\n")
+    return home
+
+
+def seed_token(home, profile, ttl=3600):
+    tokens = os.path.join(home, ".aws", "tokens.d")
+    os.makedirs(tokens, exist_ok=True)
+    with open(os.path.join(tokens, f"{profile}.json"), "w") as f:
+        json.dump({'access_key_id': 'ASIAFAKESEED', 'secret_access_key_id': 'secret',
+                   'session_token': 'token', 'expiration': time.time() + ttl}, f)
+
+
+def environment(home, **extra):
+    env = {k: v for k, v in os.environ.items() if not k.startswith("AWS_")}
+    return env | {"HOME": home, "PYTHONPATH": ROOT} | extra
+
+
+def run(args, env):
+    started = time.perf_counter()
+    result = subprocess.run(args, env=env, capture_output=True, text=True)
+    return (time.perf_counter() - started) * 1000, result
+
+
+def summary(samples):
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(samples), 2),
+        "min_ms": round(min(samples), 2),
+        "max_ms": round(max(samples), 2)
+    }
+
+
+def exec_args(profile="bench0"):
+    return [sys.executable, "-m", "vault.main", "exec", f"--profile={profile}"]
+
+
+def scenario_startup(repeat):
+    home = write_home(tempfile.mkdtemp(prefix="pyvault-bench-"))
+    seed_token(home, "bench0")
+    env = environment(home)
+    baseline = [run([sys.executable, "-c", "pass"], env)[0] for _ in range(repeat)]
+
+    cold = []
+    for _ in range(repeat):
+        shutil.rmtree(os.path.join(home, ".aws", "pyvault.cache"), ignore_errors=True)
+        cold.append(run(exec_args(), env)[0])
+    hit = [run(exec_args(), env)[0] for _ in range(repeat)]
+
+    probe = ("import sys; from vault.main import fast_exec; "
+             "assert fast_exec(['exec', '--profile=bench0']); "
+             f"sys.stderr.write(' '.join(m for m in sys.modules if m.split('.')[0] in {HEAVY_MODULES!r}))")
+    loaded = run([sys.executable, "-c", probe], env)[1].stderr.split()
+
+    overhead = statistics.median(hit) - statistics.median(baseline)
+    shutil.rmtree(home)
+    return {
+        "interpreter": summary(baseline),
+        "cold_start": summary(cold),
+        "cache_hit": summary(hit),
+        "cache_hit_overhead_ms": round(overhead, 2),
+        "budget_ms": FAST_PATH_BUDGET_MS,
+        "heavy_modules_loaded": loaded,
+        "ok": overhead <= FAST_PATH_BUDGET_MS and not loaded
+    }
+
+
+def scenario_cache_miss(repeat):
+    home = write_home(tempfile.mkdtemp(prefix="pyvault-bench-"))
+    samples = []
+    with FakeSts(latency=0) as sts:
+        env = environment(home, AWS_ENDPOINT_URL_STS=sts.url)
+        for _ in range(repeat):
+            shutil.rmtree(os.path.join(home, ".aws", "tokens.d"), ignore_errors=True)
+            elapsed, result = run(exec_args(), env)
+            samples.append(elapsed)
+        calls = len(sts.calls)
+    shutil.rmtree(home)
+    return summary(samples) | {"backend_calls": calls, "ok": calls == repeat}
+
+
+def scenario_sso(repeat):
+    # In-process, with the SSO OIDC and portal APIs answered by botocore Stubbers.
+    import webbrowser
+    from botocore.stub import Stubber
+    from vault.aws.auth import SSORoleProvider
+    from vault.aws.clients import ClientFactory
+
+    home = tempfile.mkdtemp(prefix="pyvault-bench-")
+    old_home, os.environ["HOME"] = os.environ.get("HOME"), home
+    open_new, webbrowser.open_new = webbrowser.open_new, lambda url: None
+    try:
+        clients = ClientFactory()
+        oidc = Stubber(clients.client('sso-oidc', 'eu-west-1'))
+        portal = Stubber(clients.client('sso', 'eu-west-1'))
+        expires = int(time.time()) + 90 * 86400
+        oidc.add_response('register_client', {'clientId': 'c', 'clientSecret': 's', 'clientSecretExpiresAt': expires})
+        oidc.add_response('start_device_authorization', {
+            'deviceCode': 'd', 'userCode': 'ABCD-EFGH', 'verificationUriComplete': 'https://device',
+            'expiresIn': 600, 'interval': 1})
+        oidc.add_response('create_token', {'accessToken': 'at', 'expiresIn': 28800, 'refreshToken': 'rt'})
+        for _ in range(repeat + 1):
+            portal.add_response('get_role_credentials', {'roleCredentials': {
+                'accessKeyId': 'ASIAFAKESSO', 'secretAccessKey': 's', 'sessionToken': 't',
+                'expiration': int(time.time() + 3600) * 1000}})
+        oidc.activate()
+        portal.activate()
+
+        def resolve(account):
+            profile = {'region': 'eu-west-1', 'sso_start_url': 'https://bench.awsapps.com/start',
+                       'sso_role_name': 'Bench', 'sso_account_id': account}
+            started = time.perf_counter()
+            SSORoleProvider(profile, clients=clients).auth()
+            return (time.perf_counter() - started) * 1000
+
+        first = resolve("000000000000")
+        cached = [resolve(f"{i:012d}") for i in range(1, repeat + 1)]
+        try:
+            oidc.assert_no_pending_responses()
+            portal.assert_no_pending_responses()
+            ok = True
+        except AssertionError:
+            ok = False
+    finally:
+        webbrowser.open_new = open_new
+        os.environ["HOME"] = old_home
+        shutil.rmtree(home)
+    return {"device_flow_ms": round(first, 2), "cached_token": summary(cached), "ok": ok}
+
+
+def scenario_config_sizes(sizes, repeat):
+    from vault.aws.index import ProfileIndex
+
+    results = {}
+    for size in sizes:
+        home = write_home(tempfile.mkdtemp(prefix="pyvault-bench-"), profiles=size)
+        config = os.path.join(home, ".aws", "config")
+        credentials = os.path.join(home, ".aws", "credentials")
+        cache_dir = os.path.join(home, ".aws", "pyvault.cache")
+        cold, warm = [], []
+        for _ in range(repeat):
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            started = time.perf_counter()
+            ProfileIndex(config, credentials, cache_dir)[f"bench{size - 1}"]
+            cold.append((time.perf_counter() - started) * 1000)
+            started = time.perf_counter()
+            ProfileIndex(config, credentials, cache_dir)[f"bench{size - 1}"]
+            warm.append((time.perf_counter() - started) * 1000)
+        results[str(size)] = {"compile": summary(cold), "cached_lookup": summary(warm)}
+        shutil.rmtree(home)
+    return results
+
+
+def scenario_stress(processes):
+    home = write_home(tempfile.mkdtemp(prefix="pyvault-bench-"))
+    with FakeSts(latency=0.2) as sts:
+        env = environment(home, AWS_ENDPOINT_URL_STS=sts.url)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(lambda _: run(exec_args(), env)[1], range(processes)))
+        elapsed = (time.perf_counter() - started) * 1000
+        calls = len(sts.calls)
+
+    outputs = set()
+    for result in results:
+        try:
+            outputs.add(json.loads(result.stdout)["AccessKeyId"])
+        except (ValueError, KeyError):
+            outputs.add(None)
+    try:
+        with open(os.path.join(home, ".aws", "tokens.d", "bench0.json")) as f:
+            cache_intact = json.load(f)["access_key_id"] in outputs
+    except (OSError, ValueError, KeyError):
+        cache_intact = False
+    shutil.rmtree(home)
+    return {
+        "processes": processes,
+        "wall_ms": round(elapsed, 2),
+        "backend_calls": calls,
+        "failed": sum(1 for r in results if r.returncode != 0),
+        "distinct_credentials": len(outputs),
+        "cache_intact": cache_intact,
+        "ok": calls == 1 and outputs != {None} and len(outputs) == 1 and cache_intact
+    }
+
+
+@click.command()
+@click.option("--repeat", help="Samples per timed scenario", default=10, type=int)
+@click.option("--sizes", help="Config sizes (profiles) to index", default="10,100,1000,5000")
+@click.option("--processes", help="Parallel credential_process invocations in the stress run", default=20, type=int)
+@click.option("--output", help="Write the JSON report here instead of stdout", type=click.Path())
+def main(repeat, sizes, processes, output):
+    results = {
+        "startup": scenario_startup(repeat),
+        "cache_miss": scenario_cache_miss(repeat),
+        "sso": scenario_sso(repeat),
+        "config_sizes": scenario_config_sizes([int(s) for s in sizes.split(",")], max(1, repeat // 3)),
+        "stress": scenario_stress(processes)
+    }
+    report = {
+        "pyvault": ver,
+        "python": sys.version.split()[0],
+        "timestamp": int(time.time()),
+        "results": results
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    else:
+        click.echo(text)
+    failed = [name for name, result in results.items() if result.get("ok") is False]
+    if failed:
+        click.secho(f"Failed: {', '.join(failed)}", fg="red", err=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
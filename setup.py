@@ -13,6 +13,6 @@ setup(
     use_pipfile=True,
     entry_points='''
         [console_scripts]
-        pyvault=vault.cli:cli
+        pyvault=vault.main:main
     ''',
 )
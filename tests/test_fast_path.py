@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+from benchmarks.resolution import HEAVY_MODULES, environment, seed_token, write_home
+
+# Runs in a fresh interpreter: serves `exec` from the seeded token, with the final exec replaced
+# by a no-op, then lists what got imported.
+PROBE = """
+import sys
+from vault.executor import Executor
+Executor.invoke = lambda self: None
+from vault.main import fast_exec
+served = fast_exec(["exec", "--profile=bench0"])
+heavy = sorted(m for m in sys.modules if m.split('.')[0] in {heavy!r})
+print(served, ' '.join(heavy))
+"""
+
+
+def probe(home):
+    result = subprocess.run([sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+                            env=environment(str(home)), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    served, _, heavy = result.stdout.strip().partition(" ")
+    return served == "True", heavy.split()
+
+
+def test_cache_hit_imports_no_heavy_modules(tmp_path):
+    write_home(str(tmp_path))
+    seed_token(str(tmp_path), "bench0")
+    served, heavy = probe(tmp_path)
+    assert served
+    assert heavy == []
+
+
+def test_cache_miss_falls_back(tmp_path):
+    write_home(str(tmp_path))
+    served, _ = probe(tmp_path)
+    assert not served
@@ -0,0 +1,60 @@
+import os
+import time
+
+from vault.aws.tokens import FileTokenStore, IniTokenStore
+
+
+def store(tmp_path, max_entries=3):
+    return FileTokenStore(str(tmp_path / "tokens.d"), legacy_path=str(tmp_path / "tokens"), max_entries=max_entries)
+
+
+def token(expiration):
+    return {'aws_access_key_id': 'AKIA', 'aws_secret_access_key': 'secret', 'aws_session_token': 'token',
+            'expiration': str(expiration)}
+
+
+def age(tokens, name, seconds):
+    stamp = time.time() - seconds
+    os.utime(tokens.file(name), (stamp, stamp))
+
+
+def test_evicts_least_recently_used_profile(tmp_path):
+    tokens = store(tmp_path)
+    later = time.time() + 3600
+    for name in ("old", "used", "mfa-session:base"):
+        tokens.put(name, token(later))
+        age(tokens, name, 7200)
+    age(tokens, "mfa-session:base", 9000)
+    # Looked up since it was stored; the MFA session never goes through the stats.
+    tokens.record("used", "hit")
+    tokens.put("new", token(later))
+    assert sorted(tokens.names()) == ["mfa-session:base", "new", "used"]
+    assert not os.path.exists(tokens.file("old", ".lock"))
+
+
+def test_refresh_of_an_entry_does_not_evict(tmp_path, monkeypatch):
+    tokens = store(tmp_path, max_entries=1)
+    tokens.put("a", token(time.time() + 3600))
+    monkeypatch.setattr(tokens, "evict", lambda keep=None: (_ for _ in ()).throw(AssertionError(keep)))
+    tokens.put("a", token(time.time() + 7200))
+
+
+def test_compact_drops_expired_entries_and_orphaned_locks(tmp_path):
+    tokens = store(tmp_path, max_entries=10)
+    tokens.put("live", token(time.time() + 3600))
+    tokens.put("expired", token(time.time() - 1))
+    with tokens.lock("gone"):
+        pass
+    assert tokens.compact() == ["expired"]
+    assert tokens.names() == ["live"]
+    assert tokens.lock_names() == []
+
+
+def test_ini_store_evicts(tmp_path):
+    tokens = IniTokenStore(str(tmp_path / "tokens"), max_entries=2)
+    later = time.time() + 3600
+    tokens.put("a", token(later))
+    tokens.put("mfa-session:base", token(later))
+    tokens.record("b", "hit")
+    tokens.put("b", token(later))
+    assert sorted(tokens.names()) == ["b", "mfa-session:base"]
@@ -1,16 +1,13 @@
 import os
+import threading
 import time
-import webbrowser
-
-import boto3
-import botocore
-import click
-from botocore.config import Config
 
 from vault import auth
+from vault.aws.clients import ClientFactory, default_factory
+from vault.trace import event, span
 
-config = Config(connect_timeout=5, retries={'max_attempts': 2})
 
+# botocore and click are imported lazily: a cache hit in `pyvault exec` must not pay for loading them.
 
 # boto3.set_stream_logger(name='botocore')
 
@@ -24,16 +21,39 @@ class AuthResponse(auth.Credentials):
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
         self.aws_session_token = aws_session_token
-        self.expiration = expiration
+        self.expiration = float(expiration)
 
     def to_dict(self):
         return {
             "Version": 1,
             "AccessKeyId": self.aws_access_key_id,
             "SecretAccessKey": self.aws_secret_access_key,
-            "SessionToken": self.aws_session_token
+            "SessionToken": self.aws_session_token,
+            "Expiration": self.expires_at()
+        }
+
+    def to_container_dict(self):
+        return {
+            "AccessKeyId": self.aws_access_key_id,
+            "SecretAccessKey": self.aws_secret_access_key,
+            "Token": self.aws_session_token,
+            "Expiration": self.expires_at()
         }
 
+    def client_credentials(self):
+        return {
+            'aws_access_key_id': self.aws_access_key_id,
+            'aws_secret_access_key': self.aws_secret_access_key,
+            'aws_session_token': self.aws_session_token
+        }
+
+    def expires_at(self):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.expiration))
+
+
+# Serialises MFA/SSO prompts of concurrently resolved profiles.
+prompt_lock = threading.RLock()
+
 
 class authProvider:
 
@@ -43,20 +63,21 @@ class authProvider:
 
 
 class AssumeRoleProvider(authProvider):
-    def __init__(self, profile, region=None):
+    def __init__(self, profile, region=None, clients: ClientFactory = None, source_credentials=None):
         authProvider.__init__(self)
         self.profile = profile
-        default_credentials = self.profile.default_credentials()
         if region is None:
             region = self.profile['region']
-        self.session = boto3.session.Session(
-            aws_access_key_id=default_credentials['aws_access_key_id'],
-            region_name=region,
-            aws_secret_access_key=default_credentials['aws_secret_access_key'])
-        self.sts_client = self.client_init()
+        self.region = region
+        self.clients = clients or default_factory
+        self.source_credentials = source_credentials
 
-    def client_init(self):
-        return self.session.client('sts')
+    @property
+    def sts_client(self):
+        if self.source_credentials is not None:
+            # A hop of a role chain, signed with the credentials of the previous hop.
+            return self.clients.sts(self.source_credentials.client_credentials(), self.region)
+        return self.clients.sts(self.profile.default_credentials(), self.region)
 
     def do_auth(self):
         return self.sts_client.assume_role(
@@ -64,7 +85,8 @@ class AssumeRoleProvider(authProvider):
             RoleArn=self.profile['role_arn'])
 
     def auth(self):
-        response = self.do_auth()
+        with span("sts.assume_role", profile=getattr(self.profile, "name", None)):
+            response = self.do_auth()
         role_credentials = response['Credentials']
         return AuthResponse(
             role_credentials['AccessKeyId'],
@@ -73,99 +95,270 @@ class AssumeRoleProvider(authProvider):
             role_credentials['Expiration'].timestamp())
 
 
+def mfa_session_name(profile):
+    source = profile['source_profile'] if 'source_profile' in profile else profile.name
+    return f"mfa-session:{source}"
+
+
 class MfaAssumeRoleProvider(AssumeRoleProvider):
-    def __init__(self, profile, mfa_stdin=False):
-        AssumeRoleProvider.__init__(self, profile)
+    # One MFA code buys a GetSessionToken session for the source profile, which is cached and
+    # then signs the AssumeRole calls of every role behind the same mfa_serial.
+    def __init__(self, profile, mfa_stdin=False, clients: ClientFactory = None, prompt=True):
+        AssumeRoleProvider.__init__(self, profile, clients=clients)
         self.value = None
         self.mfa_stdin = mfa_stdin
-
-    def do_auth(self):
-        if not self.mfa_stdin:
-            value = click.prompt(
-                f">>> Enter MFA for {self.profile['mfa_serial']}",
-                err=True
-            )
-        else:
-            value = input()
+        self.prompt = prompt
+
+    def read_code(self):
+        import click
+
+        if not self.prompt:
+            raise ValueError(f"MFA code needed for {self.profile['mfa_serial']}, not prompting for it")
+        with prompt_lock:
+            if not self.mfa_stdin:
+                value = click.prompt(
+                    f">>> Enter MFA for {self.profile['mfa_serial']}",
+                    err=True
+                )
+            else:
+                value = input()
         value = value.strip()
         if len(value) != 6:
             raise ValueError("MFA token should be 6 digits width")
-        return self.sts_client.assume_role(
+        return value
+
+    def get_session_token(self):
+        duration = MFA_SESSION_DURATION
+        if 'pyvault_mfa_session_duration' in self.profile:
+            duration = int(self.profile['pyvault_mfa_session_duration'])
+        code = self.read_code()
+        with span("sts.get_session_token", profile=getattr(self.profile, "name", None)):
+            response = self.sts_client.get_session_token(
+                DurationSeconds=duration,
+                SerialNumber=self.profile['mfa_serial'],
+                TokenCode=code)
+        session_credentials = response['Credentials']
+        return AuthResponse(
+            session_credentials['AccessKeyId'],
+            session_credentials['SecretAccessKey'],
+            session_credentials['SessionToken'],
+            session_credentials['Expiration'].timestamp())
+
+    def mfa_session(self):
+        from vault.aws.cfg import AwsTokens
+
+        tokens = AwsTokens(mfa_session_name(self.profile))
+        session = tokens.current(EXPIRY_SKEW)
+        if session is not None:
+            return session
+        with tokens.lock():
+            tokens.reload()
+            session = tokens.current(EXPIRY_SKEW)
+            if session is None:
+                session = self.get_session_token()
+                tokens.set_current(session)
+            return session
+
+    def do_auth(self):
+        session = self.mfa_session()
+        sts_client = self.clients.sts(session.client_credentials(), self.region)
+        return sts_client.assume_role(
             RoleSessionName='AssumeRoleSession',
             RoleArn=self.profile['role_arn'],
-            SerialNumber=self.profile['mfa_serial'],
-            TokenCode=value,
             ExternalId=self.profile['mfa_serial']
         )
 
 
 class SSORoleProvider(authProvider):
-    def __init__(self, profile, region=None):
+    def __init__(self, profile, region=None, clients: ClientFactory = None, prompt=True):
         authProvider.__init__(self)
         self.profile = profile
+        self.prompt = prompt
         self.region = self.profile['region'] if region is None else region
-        self.sso_oidc_client = boto3.client('sso-oidc', self.region, config=config)
-        self.sso_client = boto3.client('sso', self.region, config=config)
-
-    def get_oidc_token(self):
+        self.sso_region = self.profile['sso_region'] if 'sso_region' in self.profile else self.region
+        self.clients = clients or default_factory
+        from vault.aws.sso import SSOTokenCache, sso_cache_key
+        self.cache = SSOTokenCache(sso_cache_key(self.profile))
+
+    @property
+    def sso_oidc_client(self):
+        return self.clients.client('sso-oidc', self.sso_region)
+
+    @property
+    def sso_client(self):
+        return self.clients.client('sso', self.sso_region)
+
+    def register_client(self):
+        scopes = ['sso:account:access']
+        if 'sso_registration_scopes' in self.profile:
+            scopes = [s.strip() for s in self.profile['sso_registration_scopes'].split(',')]
         client_creds = self.sso_oidc_client.register_client(
             clientName='vault',
-            clientType='public')
+            clientType='public',
+            scopes=scopes)
+        self.cache.set_registration(client_creds)
+        return self.cache.registration()
+
+    def refresh_oidc_token(self, client_creds):
+        import botocore.exceptions
+
+        try:
+            return self.sso_oidc_client.create_token(
+                clientId=client_creds['clientId'],
+                clientSecret=client_creds['clientSecret'],
+                refreshToken=self.cache.refresh_token(),
+                grantType='refresh_token')
+        except botocore.exceptions.ClientError:
+            self.cache.invalidate(refresh=True)
+            return None
+
+    def get_oidc_token(self):
+        # The client registration and the tokens are shared by every profile of the same
+        # sso-session / start URL, so only the first of them ever goes through the browser.
+        # The cache lock is only held for quick decisions: a device authorization waiting for
+        # approval is published in a state file, later processes attach to it and wait.
+        from vault.aws.sso import process_alive
+
+        while True:
+            with self.cache.lock():
+                self.cache.reload()
+                token = self.cache.access_token()
+                if token is not None:
+                    event("sso.token", outcome="hit")
+                    return token
+                client_creds = self.cache.registration() or self.register_client()
+                if self.cache.refresh_token() is not None:
+                    with span("sso.token", outcome="refresh"):
+                        token = self.refresh_oidc_token(client_creds)
+                    if token is not None:
+                        self.cache.set_token(token)
+                        return token
+                if not self.prompt:
+                    # Neither a browser nor a wait for somebody else's approval behind the user's back.
+                    raise ValueError(f"SSO login needed for {self.profile['sso_start_url']}, not prompting for it")
+                pending = self.cache.pending()
+                if pending is None:
+                    pending = self.start_device_authorization(client_creds)
+                    owner = True
+                elif not process_alive(pending['owner']):
+                    # Whoever started it is gone; the code may well be approved already.
+                    pending = self.cache.set_pending(pending, owner=os.getpid())
+                    owner = True
+                else:
+                    owner = False
+            if owner:
+                with span("sso.token", outcome="device_authorization"):
+                    return self.poll_device_authorization(client_creds, pending)
+            with span("sso.token", outcome="attached"):
+                token = self.attach(pending)
+            if token is not None:
+                return token
+
+    def start_device_authorization(self, client_creds):
+        import webbrowser
+        import click
 
         device_creds = self.sso_oidc_client.start_device_authorization(
             clientId=client_creds['clientId'],
             clientSecret=client_creds['clientSecret'],
             startUrl=self.profile['sso_start_url'])
-        user_code = click.style(device_creds['userCode'], bold=True, fg="green")
-        click.echo(f">>> Please approve getting access token using following code: {user_code}", err=True)
-
-        verification_uri_complete = device_creds['verificationUriComplete']
-        webbrowser.open_new(verification_uri_complete)
+        pending = self.cache.set_pending({
+            'deviceCode': device_creds['deviceCode'],
+            'userCode': device_creds['userCode'],
+            'verificationUriComplete': device_creds['verificationUriComplete'],
+            'interval': device_creds.get('interval', 5),
+            'expiresAt': time.time() + device_creds['expiresIn']
+        })
+        with prompt_lock:
+            user_code = click.style(pending['userCode'], bold=True, fg="green")
+            click.echo(f">>> Please approve getting access token using following code: {user_code}", err=True)
+            webbrowser.open_new(pending['verificationUriComplete'])
+        return pending
+
+    def poll_device_authorization(self, client_creds, pending):
+        import botocore.exceptions
 
         slow_down_delay = 5
-        retry_interval = 5
-        if 'interval' in device_creds:
-            retry_interval = device_creds['interval']
-
-        while True:
-            try:
-                token = self.sso_oidc_client.create_token(
-                    clientId=client_creds['clientId'],
-                    clientSecret=client_creds['clientSecret'],
-                    deviceCode=device_creds['deviceCode'],
-                    grantType='urn:ietf:params:oauth:grant-type:device_code')
-                return token
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == 'SlowDownException':
-                    retry_interval += slow_down_delay
-                elif e.response['Error']['Code'] == 'AuthorizationPendingException':
-                    pass
+        retry_interval = pending['interval']
+        try:
+            while time.time() < pending['expiresAt']:
+                try:
+                    token = self.sso_oidc_client.create_token(
+                        clientId=client_creds['clientId'],
+                        clientSecret=client_creds['clientSecret'],
+                        deviceCode=pending['deviceCode'],
+                        grantType='urn:ietf:params:oauth:grant-type:device_code')
+                except botocore.exceptions.ClientError as e:
+                    code = e.response['Error']['Code']
+                    if code == 'SlowDownException':
+                        retry_interval += slow_down_delay
+                    elif code == 'ExpiredTokenException':
+                        break
+                    elif code != 'AuthorizationPendingException':
+                        raise e
                 else:
-                    raise e
-            time.sleep(retry_interval)
+                    with self.cache.lock():
+                        self.cache.set_token(token)
+                    return token
+                time.sleep(max(0, min(retry_interval, pending['expiresAt'] - time.time())))
+            raise ValueError(f"SSO device authorization {pending['userCode']} expired before it was approved")
+        finally:
+            with self.cache.lock():
+                current = self.cache.pending()
+                if current is not None and current['deviceCode'] == pending['deviceCode']:
+                    self.cache.clear_pending()
+
+    def attach(self, pending, interval=0.25):
+        # Another process owns the browser flow: watch the cache for the token it will store.
+        # None sends the caller round again (the owner failed or went away).
+        import click
+        from vault.aws.sso import process_alive
+
+        with prompt_lock:
+            click.echo(f">>> Waiting for the SSO approval of code {pending['userCode']} "
+                       f"started by another pyvault process", err=True)
+        while time.time() < pending['expiresAt']:
+            time.sleep(interval)
+            self.cache.reload()
+            token = self.cache.access_token()
+            if token is not None:
+                return token
+            current = self.cache.pending()
+            if current is None or current['deviceCode'] != pending['deviceCode'] or \
+                    not process_alive(current['owner']):
+                return None
+        return None
 
     def get_token(self):
         token = self.get_oidc_token()
-
+        try:
+            return self.get_role_credentials(token)
+        except self.sso_client.exceptions.UnauthorizedException:
+            self.revoked(token)
+            return self.get_role_credentials(self.get_oidc_token())
+
+    def revoked(self, token):
+        # The access token was revoked (e.g. signed out in the portal). Another process may
+        # have stored a new one meanwhile, that one is kept.
+        with self.cache.lock():
+            self.cache.reload()
+            current = self.cache.access_token()
+            if current is not None and current['accessToken'] == token['accessToken']:
+                self.cache.invalidate()
+
+    def get_role_credentials(self, token):
         return self.sso_client.get_role_credentials(
             roleName=self.profile['sso_role_name'],
             accountId=self.profile['sso_account_id'],
             accessToken=token['accessToken'])
 
     def generate_login_url_prefix(self):
-        login_url_prefix = "https://signin.aws.amazon.com/federation"
-        destination_domain = "console.aws.amazon.com"
-        if self.region.startswith('us-gov-'):
-            login_url_prefix = "https://signin.amazonaws-us-gov.com/federation"
-            destination_domain = "console.amazonaws-us-gov.com"
-        elif self.region.startswith('cn-'):
-            login_url_prefix = "https://signin.amazonaws.cn/federation"
-            destination_domain = "console.amazonaws.cn"
-
-        return f"{login_url_prefix}", f"https://{self.region}.{destination_domain}/console/home?region={self.region}"
+        from vault.aws.console import console_endpoints
+        return console_endpoints(self.region)
 
     def auth(self):
-        role_credentials = self.get_token()
+        with span("sso.get_role_credentials", profile=getattr(self.profile, "name", None)):
+            role_credentials = self.get_token()
         return AuthResponse(
             role_credentials['roleCredentials']['accessKeyId'],
             role_credentials['roleCredentials']['secretAccessKey'],
@@ -173,29 +366,170 @@ class SSORoleProvider(authProvider):
             role_credentials['roleCredentials']['expiration'] / 1000)
 
 
+# Cached credentials are handed out until `expiry_skew` seconds before they expire; once less than
+# `refresh_window` seconds are left they are refreshed ahead of time. Both can be set per profile
+# (or in [default]) as pyvault_refresh_window / pyvault_expiry_skew.
+REFRESH_WINDOW = 900
+EXPIRY_SKEW = 60
+# Lifetime of the GetSessionToken session an MFA code is exchanged for (pyvault_mfa_session_duration).
+MFA_SESSION_DURATION = 43200
+
+
 class Auth(auth.Auth):
-    def __init__(self, profile, mfa_stdin=False, region=None):
+    def __init__(self, profile, mfa_stdin=False, region=None, background=False, clients: ClientFactory = None,
+                 hops=(), prompt=True):
         self.profile = profile
         self.region = self.profile['region'] if region is None else region
         self.mfa_stdin = mfa_stdin
+        self.background = background
+        self.clients = clients
+        self.hops = hops + (profile.name,)
+        # False for refreshes nobody waits on: a needed MFA code or SSO approval is an error.
+        self.prompt = prompt
+
+    def setting(self, name, default):
+        if name in self.profile:
+            return float(self.profile[name])
+        return default
+
+    @property
+    def refresh_window(self):
+        return self.setting('pyvault_refresh_window', REFRESH_WINDOW)
+
+    @property
+    def expiry_skew(self):
+        return self.setting('pyvault_expiry_skew', EXPIRY_SKEW)
+
+    def interactive(self):
+        source = self.source_auth()
+        if source is not None:
+            return source.interactive()
+        if 'role_arn' in self.profile:
+            if 'mfa_serial' not in self.profile:
+                return False
+            from vault.aws.cfg import AwsTokens
+            return AwsTokens(mfa_session_name(self.profile)).current(EXPIRY_SKEW) is None
+        from vault.aws.sso import SSOTokenCache, sso_cache_key
+        return not SSOTokenCache(sso_cache_key(self.profile)).usable()
+
+    def cached(self):
+        current = self.profile.current(self.expiry_skew)
+        if current is not None and current.expiration - time.time() < self.refresh_window:
+            self.refresh_ahead()
+        return current
+
+    def fresh(self):
+        current = self.profile.current(self.expiry_skew)
+        if current is not None and current.expiration - time.time() < self.refresh_window:
+            return None
+        return current
 
     def auth(self) -> AuthResponse:
-        for y in yield_first([self.profile.current, self.do_auth]):
-            return y
+        with span("auth", profile=self.profile.name) as s:
+            current = self.cached()
+            if current is not None:
+                s.set(outcome="hit")
+                self.profile.record("hit")
+                return current
+            # Single flight across processes: whoever gets the profile lock first refreshes,
+            # everybody queued behind it picks up the freshly stored token.
+            with self.profile.lock():
+                self.profile.reload()
+                current = self.profile.current(self.expiry_skew)
+                if current is not None:
+                    s.set(outcome="coalesced")
+                    self.profile.record("coalesced")
+                    return current
+                s.set(outcome="miss")
+                self.profile.record("miss")
+                return self.do_auth()
+
+    def refresh(self, blocking=False):
+        lock = self.profile.lock()
+        if not lock.acquire(blocking=blocking):
+            return None
+        try:
+            self.profile.reload()
+            for y in yield_first([self.fresh, self.renew]):
+                return y
+        finally:
+            lock.release()
+
+    def renew(self):
+        self.profile.record("refresh")
+        return self.do_auth()
+
+    def refresh_ahead(self):
+        # Prompting for MFA or an SSO approval is never done behind the user's back,
+        # those profiles are refreshed once they reach the hard limit.
+        if self.interactive():
+            return
+        event("refresh_ahead", profile=self.profile.name, background=self.background)
+        # Forking is only safe with a single thread: the child could otherwise inherit locks
+        # (client pool, prompts, botocore's) held by a sibling and never get past them.
+        # interactive() only looked at the caches: should the refresh need the user after all, it fails.
+        refresh = self.unattended().refresh
+        if self.background or threading.active_count() > 1:
+            threading.Thread(target=refresh, daemon=True).start()
+        elif hasattr(os, 'fork'):
+            refresh_detached(refresh)
+
+    def unattended(self):
+        return Auth(self.profile, mfa_stdin=self.mfa_stdin, region=self.region, background=self.background,
+                    clients=self.clients, hops=self.hops[:-1], prompt=False)
+
+    def source_auth(self):
+        source = self.profile.source()
+        if source is None:
+            return None
+        if source.name in self.hops:
+            raise ValueError(f"Cycle in role chain: {' -> '.join(self.hops + (source.name,))}")
+        return Auth(source, mfa_stdin=self.mfa_stdin, region=self.region, background=self.background,
+                    clients=self.clients, hops=self.hops, prompt=self.prompt)
 
     def do_auth(self):
         def get_auth():
+            source = self.source_auth()
+            if source is not None:
+                # Every hop goes through its own Auth, so intermediate credentials are cached
+                # (and locked) under the intermediate profile and only the last hop is re-run.
+                return AssumeRoleProvider(self.profile, region=self.region, clients=self.clients,
+                                          source_credentials=source.auth()).auth()
             if 'role_arn' in self.profile:
                 if 'mfa_serial' in self.profile:
-                    return MfaAssumeRoleProvider(self.profile, mfa_stdin=self.mfa_stdin).auth()
-                return AssumeRoleProvider(self.profile, region=self.region).auth()
-            return SSORoleProvider(self.profile, region=self.region).auth()
+                    return MfaAssumeRoleProvider(self.profile, mfa_stdin=self.mfa_stdin, clients=self.clients,
+                                                 prompt=self.prompt).auth()
+                return AssumeRoleProvider(self.profile, region=self.region, clients=self.clients).auth()
+            return SSORoleProvider(self.profile, region=self.region, clients=self.clients, prompt=self.prompt).auth()
 
         auth = get_auth()
         self.profile.set_current(auth)
+        from vault.aws.shellstate import ShellState
+        ShellState().refreshed(self.profile.name, auth.expiration)
         return auth
 
 
+def refresh_detached(fn):
+    # Double fork so the refresh neither holds the caller's stdout open (the SDK reading a
+    # credential_process waits for EOF) nor stays around as a zombie of an exec'ed command.
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            try:
+                fn()
+            except Exception:
+                pass
+    finally:
+        os._exit(0)
+
+
 def yield_first(iterable):
     for item in iterable or []:
         res = item()
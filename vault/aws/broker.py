@@ -0,0 +1,112 @@
+import json
+import time
+from urllib.parse import quote, urlparse
+
+from vault import auth
+from vault.aws.auth import EXPIRY_SKEW, REFRESH_WINDOW, AuthResponse
+from vault.aws.cfg import AwsTokens
+from vault.trace import event, span
+
+BROKER_TIMEOUT = 10
+
+
+def unix_connection(path, timeout):
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(path)
+
+    return UnixHTTPConnection("localhost", timeout=timeout)
+
+
+class BrokerClient(object):
+    # Talks to a `pyvault serve` owning the providers and the token cache of a fleet:
+    # http://host:port, https://host:port or unix:///path/to/socket.
+
+    def __init__(self, url, token, timeout=BROKER_TIMEOUT, ca_file=None):
+        self.url = urlparse(url)
+        self.token = token or ""
+        self.timeout = timeout
+        self.ca_file = ca_file
+
+    def connection(self):
+        import http.client
+
+        if self.url.scheme == "unix":
+            return unix_connection(self.url.path, self.timeout)
+        if self.url.scheme == "https":
+            import ssl
+            context = ssl.create_default_context(cafile=self.ca_file)
+            return http.client.HTTPSConnection(self.url.hostname, self.url.port, timeout=self.timeout,
+                                               context=context)
+        if self.url.scheme == "http":
+            return http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+        raise ValueError(f"Unsupported broker URL: {self.url.geturl()}")
+
+    def fetch(self, name):
+        conn = self.connection()
+        try:
+            conn.request("GET", "/" + quote(name, safe=''), headers={"Authorization": self.token})
+            response = conn.getresponse()
+            body = json.loads(response.read() or b"{}")
+        finally:
+            conn.close()
+        if response.status == 404:
+            raise KeyError(body.get("message", name))
+        if response.status != 200:
+            raise ValueError(f"Broker refused {name}: {response.status} {body.get('message', '')}")
+        # The TTL rather than the absolute expiry, so a skewed clock on either side doesn't matter.
+        credentials = AuthResponse(body["AccessKeyId"], body["SecretAccessKey"], body["Token"],
+                                   time.time() + body["Ttl"])
+        return credentials, body.get("Region")
+
+
+class BrokerAuth(auth.Auth):
+    # Credentials come from the broker and are kept in the local token cache. When the broker
+    # can't be reached, the local copy is handed out for as long as it is valid.
+
+    def __init__(self, name, client: BrokerClient = None, region=None, tokens: AwsTokens = None):
+        self.name = name
+        self.client = client
+        self.region = region
+        self.tokens = tokens or AwsTokens(name)
+
+    def cached(self):
+        current = self.tokens.current(EXPIRY_SKEW)
+        if current is not None and current.expiration - time.time() >= REFRESH_WINDOW:
+            return current
+        return None
+
+    def details(self, reader):
+        if self.name in reader:
+            profile = reader[self.name]
+            if self.region is None and 'region' in profile:
+                return {'region': profile['region']}
+        return {'region': self.region}
+
+    def auth(self) -> AuthResponse:
+        with span("broker.auth", profile=self.name) as s:
+            current = self.cached()
+            if current is not None:
+                s.set(outcome="hit")
+                self.tokens.record("hit")
+                return current
+            try:
+                credentials, region = self.client.fetch(self.name)
+            except OSError as e:
+                current = self.tokens.current(EXPIRY_SKEW)
+                if current is None:
+                    raise ValueError(f"Broker unreachable ({e}) and no cached credentials for {self.name}")
+                event("broker.fallback", profile=self.name, error=str(e))
+                s.set(outcome="fallback")
+                return current
+            s.set(outcome="broker")
+            self.tokens.record("miss")
+            self.region = self.region or region
+            self.tokens.set_current(credentials)
+            return credentials
@@ -0,0 +1,165 @@
+import json
+import os
+import re
+import time
+import zlib
+from os.path import expanduser
+
+from vault.files import FileLock, atomic_write
+from vault.trace import span
+
+# Account role lists older than this are fetched again by `pyvault sso discover`.
+CATALOG_TTL = 86400
+DISCOVERY_JOBS = 16
+
+
+def sso_sources(index):
+    # Everything discovery can log in with: [sso-session ...] sections and legacy profiles
+    # carrying an sso_start_url of their own, one per login.
+    from vault.aws.sso import sso_cache_key
+
+    sources, seen = [], set()
+    for key, entry in index.entries.items():
+        if 'error' in entry:
+            continue
+        settings = entry['settings']
+        if key.startswith("sso-session "):
+            settings = settings | {'sso_session': entry['name']}
+        elif 'sso_session' in settings or 'sso_account_id' in settings:
+            continue
+        if 'sso_start_url' not in settings:
+            continue
+        cache_key = sso_cache_key(settings)
+        if cache_key not in seen:
+            seen.add(cache_key)
+            sources.append((entry['name'], settings))
+    return sources
+
+
+def slug(name):
+    return re.sub(r"[^A-Za-z0-9_.+=@-]+", "-", name).strip("-")
+
+
+class SSOCatalog(object):
+    # Account/role pairs reachable through one SSO login, exposed as `<source>/<account>/<role>`
+    # virtual profiles.
+
+    def __init__(self, source, settings, path="~/.aws/pyvault.cache"):
+        self.source = source
+        self.settings = settings
+        self.region = settings.get('region') or settings['sso_region']
+        name = zlib.crc32(f"{source}:{settings['sso_start_url']}".encode())
+        self.path = os.path.join(expanduser(path), f"sso-catalog-{name:08x}.json")
+        self.data = {}
+        self.reload()
+
+    def reload(self):
+        self._profiles = None
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def flush(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        atomic_write(self.path, lambda f: json.dump(self.data, f))
+
+    def lock(self):
+        return FileLock(f"{self.path}.lock")
+
+    @property
+    def accounts(self):
+        return self.data.get('accounts', {})
+
+    def profiles(self) -> dict:
+        if self._profiles is None:
+            self._profiles = self.compile()
+        return self._profiles
+
+    def compile(self):
+        names = {}
+        for account in self.accounts.values():
+            names[account['name']] = names.get(account['name'], 0) + 1
+        result = {}
+        for account_id, account in self.accounts.items():
+            label = account['name'] if account['name'] and names[account['name']] == 1 else account_id
+            for role in account['roles']:
+                name = f"{self.source}/{label}/{role}"
+                result[name] = self.entry(name, account_id, role)
+        return result
+
+    def entry(self, name, account_id, role):
+        settings = self.settings | {'sso_account_id': account_id, 'sso_role_name': role, 'region': self.region}
+        return {
+            'name': name,
+            'section': {},
+            'nested': None,
+            'own_keys': None,
+            'credentials': None,
+            'settings': settings,
+            'chain': [],
+            'summary': {'kind': 'sso', 'account': account_id, 'role': role, 'region': self.region}
+        }
+
+    def discover(self, provider, ttl=CATALOG_TTL, jobs=DISCOVERY_JOBS, force=False):
+        # The account list is always re-read, it is a handful of pages even for large
+        # organisations; roles are only listed for new accounts and those older than `ttl`,
+        # one request per account, in parallel.
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self.lock():
+            self.reload()
+            token = provider.get_oidc_token()
+            try:
+                listed = self.list_accounts(provider, token)
+            except provider.sso_client.exceptions.UnauthorizedException:
+                provider.revoked(token)
+                token = provider.get_oidc_token()
+                listed = self.list_accounts(provider, token)
+
+            now = time.time()
+            previous = self.accounts
+            accounts, stale = {}, []
+            for account in listed:
+                known = previous.get(account['accountId'])
+                accounts[account['accountId']] = {
+                    'name': slug(account.get('accountName', '')),
+                    'roles': known['roles'] if known else [],
+                    'updated': known['updated'] if known else 0
+                }
+                if force or known is None or now - known['updated'] > ttl:
+                    stale.append(account['accountId'])
+
+            def _roles(account_id):
+                return account_id, self.list_roles(provider, token, account_id)
+
+            with span("sso.discover", source=self.source, accounts=len(accounts), fetched=len(stale)):
+                with ThreadPoolExecutor(max_workers=jobs) as pool:
+                    for account_id, roles in pool.map(_roles, stale):
+                        accounts[account_id]['roles'] = roles
+                        accounts[account_id]['updated'] = now
+
+            self.data = {'source': self.source, 'start_url': self.settings['sso_start_url'],
+                         'updated': now, 'accounts': accounts}
+            self._profiles = None
+            self.flush()
+            return len(stale)
+
+    def list_accounts(self, provider, token):
+        paginator = provider.sso_client.get_paginator('list_accounts')
+        accounts = []
+        for page in paginator.paginate(accessToken=token['accessToken']):
+            accounts += page['accountList']
+        return accounts
+
+    def list_roles(self, provider, token, account_id):
+        paginator = provider.sso_client.get_paginator('list_account_roles')
+        roles = []
+        for page in paginator.paginate(accessToken=token['accessToken'], accountId=account_id):
+            roles += [r['roleName'] for r in page['roleList']]
+        return sorted(roles)
+
+
+def catalogs(index) -> list:
+    return [SSOCatalog(source, settings) for source, settings in sso_sources(index)]
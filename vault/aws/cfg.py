@@ -1,22 +1,26 @@
-import configparser
 import os
+import threading
 import time
 from os.path import expanduser
-from pathlib import Path
-
-import click
 
 from vault.aws.auth import AuthResponse
+from vault.aws.index import ProfileIndex, credential_view, profile_name
+from vault.aws.tokens import TokenStore, token_store
+from vault.files import atomic_write
+from vault.trace import span
 from vault.list import ProfilesListing
 from vault.shell import ShellInit
 
 
 class iniIO(object):
     def __init__(self, path, section):
+        import configparser
+
         self.path = expanduser(path)
         self.section = section
         self.parser = configparser.ConfigParser()
-        Path(self.path).touch()
+        with open(self.path, "a"):
+            pass
         self.parser.read(self.path)
 
     def __contains__(self, name):
@@ -28,8 +32,7 @@ class iniIO(object):
         return None
 
     def flush(self):
-        with open(self.path, "w+") as f:
-            self.parser.write(f)
+        atomic_write(self.path, self.parser.write)
 
     def __setitem__(self, key, value):
         if not self.parser.has_section(self.section):
@@ -37,24 +40,33 @@ class iniIO(object):
         self.parser.set(self.section, key, value)
 
 
-class AwsTokens(iniIO):
+class AwsTokens(object):
 
-    def __init__(self, name, path="~/.aws/tokens"):
+    def __init__(self, name, store: TokenStore = None):
         self.name = name
-        self.path = expanduser(path)
-        with open(self.path, "a+") as _:
+        self.store = store or token_store()
+        with span("tokens.read", profile=name) as s:
+            self.token = self.store.get(name)
+            s.set(found=self.token is not None)
+
+    def lock(self):
+        return self.store.lock(self.name)
+
+    def record(self, event):
+        try:
+            self.store.record(self.name, event)
+        except OSError:
             pass
-        iniIO.__init__(self, self.path, self.name)
-        if self.parser.has_section(name):
-            self.token = self.parser[name]
-        else:
-            self.token = None
 
-    def current(self):
+    def reload(self):
+        self.store.reload()
+        self.token = self.store.get(self.name)
+
+    def current(self, skew=0):
         if self.token is None:
             return None
         now = time.time()
-        if now > float(self.token['expiration']):
+        if now + skew > float(self.token['expiration']):
             return None
         return AuthResponse(
             self.token['access_key_id'],
@@ -62,79 +74,83 @@ class AwsTokens(iniIO):
             self.token['session_token'],
             self.token['expiration'])
 
-
-class AwsCredentials(iniIO):
-
-    def __init__(self, profile_name, path="~/.aws/credentials"):
-        self.profile_name = profile_name
-        iniIO.__init__(self, path, profile_name)
-
-    def __getitem__(self, item):
-        if self.parser.has_section(self.profile_name):
-            return self.parser.get(self.profile_name, item)
-        return None
-
-    def exists(self):
-        return self.parser.has_section(self.profile_name)
+    def set_current(self, auth_response: AuthResponse):
+        self.token = {
+            'access_key_id': auth_response.aws_access_key_id,
+            'secret_access_key_id': auth_response.aws_secret_access_key,
+            'session_token': auth_response.aws_session_token,
+            'expiration': auth_response.expiration
+        }
+        with span("tokens.write", profile=self.name):
+            self.store.put(self.name, self.token)
 
 
 class AwsProfile(object):
 
-    def __init__(self, name, reader: configparser.ConfigParser, creds, token, section_key='profile '):
+    def __init__(self, name, entry, token, index=None):
         self.name = name
-        self.creds = creds
-        self.section = reader[section_key + str(name)]
+        self.entry = entry
+        self.section = entry['section']
+        self.settings = entry['settings']
         self.token = token
-        self.nested = None
-        nested_profile = None
-        sso_session = None
-        if 'include_profile' in self.section:
-            nested_profile = self.section['include_profile']
-        elif 'source_profile' in self.section:
-            nested_profile = self.section['source_profile']
-        elif 'sso_session' in self.section:
-            sso_session = self.section['sso_session']
-        if sso_session is not None:
-            self.nested = AwsProfile(sso_session, reader, AwsCredentials(sso_session), token, section_key='sso-session ')
-        elif nested_profile is not None:
-            self.nested = AwsProfile(nested_profile, reader, AwsCredentials(nested_profile), token)
-        elif reader.has_section('default') and name != 'default':
-            self.nested = AwsProfile('default', reader, AwsCredentials(nested_profile), token, section_key='')
+        self.index = index
+
+    @property
+    def nested(self):
+        if self.index is None or self.entry['nested'] is None:
+            return None
+        nested = self.index.nested(self.entry)
+        return AwsProfile(nested['name'], nested, self.token, self.index)
 
     def default_credentials(self):
-        if self.creds is not None and self.creds.exists():
-            return self.creds
-        elif self.nested is not None and self.nested.creds is not None and self.nested.creds.exists():
-            return self.nested.creds
-        return None
+        if self.index is None:
+            return None
+        return self.index.credentials(self.entry)
+
+    def source(self):
+        # The previous hop of a role chain: a source_profile that itself has to be assumed
+        # (a role or an SSO account) rather than one holding long-term keys.
+        if 'role_arn' not in self.section or 'source_profile' not in self.section or self.index is None:
+            return None
+        name = self.section['source_profile']
+        entry = self.index[name]
+        if 'role_arn' not in entry['settings'] and 'sso_account_id' not in entry['settings']:
+            return None
+        return AwsProfile(name, entry, AwsTokens(name), self.index)
 
     def __contains__(self, name):
-        return name in self.section or (self.nested is not None and name in self.nested)
+        return name in self.settings
 
     def __getitem__(self, name):
-        if name in self.section:
-            return self.section[name]
-        elif self.nested is None:
-            raise KeyError(f'No such field: {name}')
-        return self.nested[name]
+        if name in self.settings:
+            return self.settings[name]
+        raise KeyError(f'No such field: {name}')
+
+    def current(self, skew=0):
+        return self.token.current(skew)
 
-    def current(self):
-        return self.token.current()
+    def lock(self):
+        return self.token.lock()
+
+    def record(self, event):
+        self.token.record(event)
+
+    def reload(self):
+        self.token.reload()
 
     def set_current(self, auth_response: AuthResponse):
-        self.token['access_key_id'] = auth_response.aws_access_key_id
-        self.token['secret_access_key_id'] = auth_response.aws_secret_access_key
-        self.token['session_token'] = auth_response.aws_session_token
-        self.token['expiration'] = str(auth_response.expiration)
-        self.token.flush()
+        self.token.set_current(auth_response)
 
 
 class AwsConfigReader(ProfilesListing):
 
-    def __init__(self, config_path='~/.aws/config'):
+    def __init__(self, config_path='~/.aws/config', credentials_path='~/.aws/credentials'):
         self.path = expanduser(config_path)
-        self.config_reader = configparser.ConfigParser()
-        self.config_reader.read(self.path)
+        self.index = ProfileIndex(config_path=config_path, credentials_path=credentials_path)
+        self._catalogs = None
+        # Called with the names refresh() found changed, whichever thread ran it.
+        self.listeners = []
+        self.refresh_lock = threading.Lock()
 
     def __enter__(self):
         return self
@@ -142,13 +158,78 @@ class AwsConfigReader(ProfilesListing):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
+    @property
+    def catalogs(self):
+        # Discovered SSO account/role pairs, only looked at when a name isn't in the config.
+        if self._catalogs is None:
+            from vault.aws.catalog import catalogs
+            self._catalogs = catalogs(self.index)
+        return self._catalogs
+
+    def virtual(self, profile):
+        for catalog in self.catalogs:
+            if profile.startswith(f"{catalog.source}/"):
+                entry = catalog.profiles().get(profile)
+                if entry is not None:
+                    return entry
+        return None
+
+    def __contains__(self, profile):
+        return profile in self.index or self.virtual(profile) is not None
+
     def __getitem__(self, profile):
-        return AwsProfile(profile, self.config_reader, AwsCredentials(profile), AwsTokens(profile))
+        try:
+            entry = self.index[profile]
+        except KeyError:
+            entry = self.virtual(profile)
+            if entry is None:
+                raise
+        return AwsProfile(profile, entry, AwsTokens(profile), self.index)
+
+    def refresh(self, store: TokenStore = None):
+        # Picks up edits of the config and credentials files. Returns the profiles that resolve
+        # differently now; of those, only the tokens issued from settings that changed are dropped.
+        with self.refresh_lock:
+            before = self.index.entries
+            changed = self.index.refresh()
+            if not changed:
+                return []
+            self._catalogs = None
+            store = store or token_store()
+            names = []
+            for key in changed:
+                name = profile_name(key)
+                if name is None:
+                    continue
+                names.append(name)
+                if credential_view(before, key) != credential_view(self.index.entries, key):
+                    store.discard(name)
+            for listener in self.listeners:
+                listener(names)
+            return names
 
     def list_profiles(self, fn):
-        profiles = map(lambda item: item[item.startswith("profile ") and len("profile "):],
-                       self.config_reader.sections())
-        fn("AWS", list(filter(lambda item: item != "default", profiles)))
+        fn("AWS", list(filter(lambda item: item != "default", self.index.profiles())))
+        for catalog in self.catalogs:
+            profiles = list(catalog.profiles())
+            if profiles:
+                fn(f"SSO {catalog.source}", profiles)
+
+    def summaries(self):
+        for name, summary in self.index.summaries():
+            if name != "default":
+                yield name, summary
+        for catalog in self.catalogs:
+            for name, entry in catalog.profiles().items():
+                yield name, entry['summary']
+
+    def annotated_profiles(self, store: TokenStore = None):
+        # Everything but the cache state comes precompiled from the index; tokens are read one by
+        # one as the rows are consumed, so a picker can render the first rows straight away.
+        store = store or token_store()
+        for name, summary in self.summaries():
+            token = store.get(name)
+            yield name, summary, float(token['expiration']) if token else None
 
 
 class AWSShellInit(ShellInit, iniIO):
@@ -157,14 +238,28 @@ class AWSShellInit(ShellInit, iniIO):
     def __init__(self, config="~/.aws/pyvault"):
         iniIO.__init__(self, config, self.section)
 
-    def shell_init(self):
-        print("# Please add this string into your shell")
-        print("# eval \"$(pyvault init)\"")
-        print("export AWS_PROFILE=`pyvault get --raw`")
+    def shell_init(self, shell=None):
+        from vault.aws.shellstate import ShellState, detect_shell
+
+        shell = shell or detect_shell()
+        state = ShellState()
+        selected = self.shell_get()
+        if selected is not None and state.read() is None:
+            state.write(selected, self.expiration(selected))
+        rc = {"bash": "~/.bashrc", "zsh": "~/.zshrc", "fish": "~/.config/fish/config.fish"}.get(shell, "~/.profile")
+        print(f"# Add these lines to {rc}, sourcing the generated profile file starts no pyvault process")
+        print(state.snippet(shell))
 
     def shell_set(self, profile_name=None):
+        from vault.aws.shellstate import ShellState
+
         self["profile"] = profile_name
         self.flush()
+        ShellState().write(profile_name, self.expiration(profile_name))
+
+    def expiration(self, profile_name):
+        token = token_store().get(profile_name)
+        return float(token['expiration']) if token else None
 
     def shell_get(self):
         if not self.parser.has_section(self.section):
@@ -172,6 +267,8 @@ class AWSShellInit(ShellInit, iniIO):
         return self.parser.get(self.section, "profile")
 
     def shell_exec(self, tool, arguments):
+        import click
+
         env = os.environ.copy()
         selected = self.shell_get()
 
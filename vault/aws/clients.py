@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+from vault.trace import span
+
+# Clients are kept alive (with their connection pools) until this many newer ones were created.
+MAX_CLIENTS = 64
+
+
+def client_config():
+    from botocore.config import Config
+    return Config(connect_timeout=5, retries={'max_attempts': 2})
+
+
+class ClientFactory(object):
+    # A single botocore session, so service models are loaded once, and clients pooled by
+    # (service, region, credentials) so repeated refreshes reuse their TLS connections.
+    # botocore is only imported once the first client is actually needed.
+
+    def __init__(self, max_clients=MAX_CLIENTS):
+        self.session = None
+        self.clients = OrderedDict()
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+
+    def botocore_session(self):
+        if self.session is None:
+            with span("import", module="botocore"):
+                import botocore.session
+            self.session = botocore.session.get_session()
+            self.session.set_config_variable('sts_regional_endpoints', 'regional')
+        return self.session
+
+    def client(self, service, region, credentials=None):
+        credentials = credentials or {}
+        key = (service, region, credentials.get('aws_access_key_id'), credentials.get('aws_session_token'))
+        with self.lock:
+            if key in self.clients:
+                self.clients.move_to_end(key)
+                return self.clients[key]
+            session = self.botocore_session()
+            with span("client.create", service=service, region=region):
+                client = session.create_client(
+                    service,
+                    region_name=region,
+                    config=client_config(),
+                    aws_access_key_id=credentials.get('aws_access_key_id'),
+                    aws_secret_access_key=credentials.get('aws_secret_access_key'),
+                    aws_session_token=credentials.get('aws_session_token'))
+            self.clients[key] = client
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+            return client
+
+    def sts(self, credentials, region):
+        return self.client('sts', region, credentials)
+
+
+default_factory = ClientFactory()
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from urllib.parse import quote_plus, urlencode
+
+from vault.aws.auth import AuthResponse
+from vault.aws.tokens import TokenStore, token_store
+
+# Federation sign-in tokens are valid for 15 minutes; one is not reused in its last minute.
+SIGNIN_TOKEN_TTL = 900
+SIGNIN_TOKEN_SKEW = 60
+FEDERATION_TIMEOUT = 10
+
+
+def console_endpoints(region):
+    login_url_prefix = "https://signin.aws.amazon.com/federation"
+    destination_domain = "console.aws.amazon.com"
+    if region.startswith('us-gov-'):
+        login_url_prefix = "https://signin.amazonaws-us-gov.com/federation"
+        destination_domain = "console.amazonaws-us-gov.com"
+    elif region.startswith('cn-'):
+        login_url_prefix = "https://signin.amazonaws.cn/federation"
+        destination_domain = "console.amazonaws.cn"
+
+    return f"{login_url_prefix}", f"https://{region}.{destination_domain}/console/home?region={region}"
+
+
+def signin_name(profile_name):
+    return f"signin:{profile_name}"
+
+
+class SharedSession(object):
+    # One requests session for the sign-ins of a command, created by the first of them that
+    # misses the cache: a login served from cached sign-in tokens never imports requests.
+
+    def __init__(self):
+        self.session = None
+        self.lock = threading.Lock()
+
+    def get(self, *args, **kwargs):
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+        return self.session.get(*args, **kwargs)
+
+
+class ConsoleLogin(object):
+    # Sign-in tokens are kept in the token store next to the credentials they were made from,
+    # and only reused for those very credentials and the same partition's endpoint.
+
+    def __init__(self, profile_name, credentials: AuthResponse, region, session_duration=None,
+                 store: TokenStore = None, http=None):
+        self.name = profile_name
+        self.credentials = credentials
+        self.region = region
+        self.session_duration = session_duration
+        self.store = store or token_store()
+        self.http = http
+
+    def cached_token(self):
+        entry = self.store.get(signin_name(self.name))
+        if entry is None or entry.get('access_key_id') != self.credentials.aws_access_key_id:
+            return None
+        if entry.get('federation') != console_endpoints(self.region)[0]:
+            return None
+        if float(entry['expiration']) < time.time() + SIGNIN_TOKEN_SKEW:
+            return None
+        return entry['signin_token']
+
+    def fetch_token(self):
+        if self.http is None:
+            import requests
+            self.http = requests.Session()
+        federation, _ = console_endpoints(self.region)
+        params = {
+            'Action': 'getSigninToken',
+            'Session': json.dumps({
+                'sessionId': self.credentials.aws_access_key_id,
+                'sessionKey': self.credentials.aws_secret_access_key,
+                'sessionToken': self.credentials.aws_session_token
+            })
+        }
+        if self.session_duration is not None:
+            params['SessionDuration'] = str(self.session_duration)
+        response = self.http.get(federation, params=params, timeout=FEDERATION_TIMEOUT)
+        if response.status_code != 200:
+            raise ValueError(f"Federation endpoint refused the credentials of {self.name}: {response.status_code}")
+        return response.json()['SigninToken']
+
+    def signin_token(self):
+        token = self.cached_token()
+        if token is not None:
+            return token
+        token = self.fetch_token()
+        self.store.put(signin_name(self.name), {
+            'signin_token': token,
+            'access_key_id': self.credentials.aws_access_key_id,
+            'federation': console_endpoints(self.region)[0],
+            'expiration': min(time.time() + SIGNIN_TOKEN_TTL, self.credentials.expiration)
+        })
+        return token
+
+    def url(self, destination=None):
+        federation, console = console_endpoints(self.region)
+        query = urlencode({
+            'Action': 'login',
+            'Issuer': 'pyvault',
+            'Destination': destination or console,
+            'SigninToken': self.signin_token()
+        }, quote_via=quote_plus)
+        return f"{federation}?{query}"
@@ -0,0 +1,114 @@
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vault.aws.env import AwsEnv
+from vault.aws.warm import Warmer
+from vault.executor import Executor
+
+
+class RunResult(object):
+
+    def __init__(self, profile, returncode=None, resolve_time=0.0, run_time=0.0, error=None):
+        self.profile = profile
+        self.returncode = returncode
+        self.resolve_time = resolve_time
+        self.run_time = run_time
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.returncode == 0
+
+    @property
+    def exit_code(self):
+        # Exit status a failed run stands for: a child killed by a signal has a negative returncode,
+        # which shells report as 128 + signum; one that never ran counts as 1.
+        if self.returncode is None:
+            return 1
+        return 128 - self.returncode if self.returncode < 0 else self.returncode or 1
+
+
+class ProfileOutput(object):
+    # Child output, line by line with a `profile | ` prefix, or (collect) held back until the
+    # child exits and then written as one block, so profiles never interleave.
+
+    def __init__(self, width, collect=False, stdout=None, stderr=None):
+        self.width = width
+        self.collect = collect
+        self.stdout = stdout or sys.stdout.buffer
+        self.stderr = stderr or sys.stderr.buffer
+        self.lock = threading.Lock()
+
+    def prefix(self, profile):
+        return f"{profile:<{self.width}} | ".encode()
+
+    def write(self, target, lines):
+        with self.lock:
+            target.writelines(lines)
+            target.flush()
+
+    def pump(self, profile, stream, target, held):
+        prefix = self.prefix(profile)
+        for line in iter(stream.readline, b''):
+            line = prefix + (line if line.endswith(b"\n") else line + b"\n")
+            if self.collect:
+                held.append((target, line))
+            else:
+                self.write(target, [line])
+        stream.close()
+
+    def attach(self, profile, proc):
+        held = []
+        threads = [threading.Thread(target=self.pump, args=(profile, proc.stdout, self.stdout, held)),
+                   threading.Thread(target=self.pump, args=(profile, proc.stderr, self.stderr, held))]
+        for t in threads:
+            t.start()
+
+        def _finish():
+            for t in threads:
+                t.join()
+            with self.lock:
+                for target, line in held:
+                    target.write(line)
+                self.stdout.flush()
+                self.stderr.flush()
+
+        return _finish
+
+
+class FanOut(object):
+    # Every worker resolves a profile and then runs the command with it, so the first commands
+    # start while credentials for the remaining profiles are still being fetched.
+
+    def __init__(self, reader, arguments, jobs=8, mfa_stdin=False, region=None, output: ProfileOutput = None):
+        self.reader = reader
+        self.arguments = list(arguments)
+        self.jobs = jobs
+        self.region = region
+        self.warmer = Warmer(reader, jobs=jobs, mfa_stdin=mfa_stdin, region=region)
+        self.output = output
+
+    def run_one(self, name):
+        resolved = self.warmer.warm_one(name)
+        if not resolved.ok:
+            return RunResult(name, resolve_time=resolved.duration, error=resolved.error)
+        env = AwsEnv(self.reader[name], resolved.credentials, region=self.region)
+        started = time.perf_counter()
+        try:
+            proc = Executor(env, resolved.credentials).spawn(
+                *self.arguments, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            return RunResult(name, resolve_time=resolved.duration, error=e)
+        finish = self.output.attach(name, proc)
+        returncode = proc.wait()
+        finish()
+        return RunResult(name, returncode, resolved.duration, time.perf_counter() - started)
+
+    def run(self, names) -> list:
+        if self.output is None:
+            self.output = ProfileOutput(max([len(n) for n in names] + [0]))
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(self.run_one, names))
@@ -0,0 +1,236 @@
+import marshal
+import os
+import zlib
+from os.path import expanduser
+
+from vault.files import atomic_write, file_stamp
+from vault.trace import span
+
+
+def profile_key(name):
+    return name if name == 'default' else f"profile {name}"
+
+
+def section_name(key):
+    for prefix in ("profile ", "sso-session "):
+        if key.startswith(prefix):
+            return key[len(prefix):]
+    return key
+
+
+def profile_name(key):
+    if key == 'default':
+        return key
+    return key[len("profile "):] if key.startswith("profile ") else None
+
+
+ERROR_SUMMARY = {'kind': 'error', 'account': '', 'role': '', 'region': ''}
+# Settings that don't go into the credentials: tokens issued before they changed stay good.
+PRESENTATION_SETTINGS = {'region', 'output'}
+
+
+def role_parts(arn):
+    # arn:aws:iam::123456789012:role/path/Name -> (123456789012, Name)
+    parts = arn.split(':', 5)
+    if len(parts) != 6:
+        return None, None
+    return parts[4], parts[5].rsplit('/', 1)[-1]
+
+
+def summarize(settings):
+    # What the profile picker shows next to a name, computed once per config change.
+    if 'role_arn' in settings:
+        account, role = role_parts(settings['role_arn'])
+        kind = 'mfa-role' if 'mfa_serial' in settings else 'role'
+    elif 'sso_account_id' in settings or 'sso_start_url' in settings:
+        account, role, kind = settings.get('sso_account_id'), settings.get('sso_role_name'), 'sso'
+    else:
+        account, role, kind = None, None, 'keys'
+    return {'kind': kind, 'account': account or '', 'role': role or '', 'region': settings.get('region', '')}
+
+
+def keys_digest(credentials):
+    # Long-term keys never go into the index, only enough to tell that they changed.
+    if credentials is None:
+        return None
+    import hashlib
+    return hashlib.sha256(repr(sorted(credentials.items())).encode()).hexdigest()
+
+
+def credential_view(entries, key):
+    # What a token of the profile was issued from: every hop of its chain, keys included.
+    entry = entries.get(key)
+    if entry is None or 'error' in entry:
+        return None
+    return [({k: v for k, v in entries[hop]['section'].items() if k not in PRESENTATION_SETTINGS},
+             entries[hop]['own_keys']) for hop in entry['chain']]
+
+
+class ProfileIndex(object):
+    # Compiled entries are persisted with marshal, which is the fastest stdlib format to load;
+    # bump the version whenever the layout of the entries changes.
+    version = 4
+
+    def __init__(self, config_path='~/.aws/config', credentials_path='~/.aws/credentials',
+                 cache_dir='~/.aws/pyvault.cache'):
+        self.config_path = expanduser(config_path)
+        self.credentials_path = expanduser(credentials_path)
+        name = zlib.crc32(f"{self.config_path}:{self.credentials_path}".encode())
+        self.cache_path = os.path.join(expanduser(cache_dir), f"index-{name:08x}.bin")
+        self.loaded = None
+        self.entries = self.load()
+
+    def stamp(self):
+        return [self.version, marshal.version, self.config_path, file_stamp(self.config_path),
+                self.credentials_path, file_stamp(self.credentials_path)]
+
+    def load(self):
+        stamp = self.loaded = self.stamp()
+        with span("index.load") as s:
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    cached = marshal.loads(f.read())
+                if cached['stamp'] == stamp:
+                    s.set(outcome="hit", profiles=len(cached['entries']))
+                    return cached['entries']
+            except (OSError, EOFError, ValueError, TypeError, KeyError):
+                pass
+            s.set(outcome="miss")
+        with span("index.compile") as s:
+            entries = self.compile(*self.parse())
+            s.set(profiles=len(entries))
+        self.store(stamp, entries)
+        return entries
+
+    def store(self, stamp, entries):
+        try:
+            with span("index.store"):
+                os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+                atomic_write(self.cache_path, lambda f: marshal.dump({'stamp': stamp, 'entries': entries}, f), 'wb')
+        except OSError:
+            pass
+
+    def refresh(self):
+        # For resident processes: after an edit only the sections that differ, and the entries
+        # whose chain goes through one of them, are compiled again. Returns their keys.
+        stamp = self.stamp()
+        if stamp == self.loaded:
+            return set()
+        with span("index.refresh") as s:
+            sections, credentials = self.parse()
+            old = self.entries
+            edited = {key for key in sections.keys() | old.keys()
+                      if key not in sections or key not in old or 'error' in old[key]
+                      or old[key]['section'] != sections[key]
+                      or old[key]['own_keys'] != keys_digest(credentials.get(section_name(key)))}
+            if 'default' in edited:
+                # [default] sits underneath every profile without a chain of its own.
+                edited |= sections.keys() | old.keys()
+            affected = edited | {key for key, entry in old.items() if 'error' not in entry and edited & set(entry['chain'])}
+            keep = {key: entry for key, entry in old.items() if key not in affected}
+            self.entries = self.compile(sections, credentials, keep)
+            self.loaded = stamp
+            s.set(edited=len(edited), recompiled=len(affected), kept=len(keep))
+        self.store(stamp, self.entries)
+        return affected
+
+    def parse(self):
+        import configparser
+
+        config = configparser.ConfigParser()
+        config.read(self.config_path)
+        credentials = configparser.ConfigParser()
+        credentials.read(self.credentials_path)
+        return ({key: dict(config[key]) for key in config.sections()},
+                {name: dict(credentials[name]) for name in credentials.sections()})
+
+    def compile(self, sections, credentials, keep=None):
+        entries = dict(keep or {})
+
+        def resolve(key, stack):
+            if key in entries:
+                return entries[key]
+            if key in stack:
+                chain = ' -> '.join(stack[stack.index(key):] + [key])
+                return {'error': f"Cycle in profile chain: {chain}"}
+            if key not in sections:
+                return {'error': f"No such profile: {key}"}
+
+            section = sections[key]
+            name = section_name(key)
+            # Same precedence as the AWS CLI: an explicit include/source profile, then the
+            # sso-session, and [default] underneath everything else.
+            nested, inherit_credentials = None, True
+            if 'include_profile' in section:
+                nested = profile_key(section['include_profile'])
+            elif 'source_profile' in section:
+                nested = profile_key(section['source_profile'])
+            elif 'sso_session' in section:
+                nested = f"sso-session {section['sso_session']}"
+            elif 'default' in sections and key != 'default':
+                nested, inherit_credentials = 'default', False
+
+            own_keys = keys_digest(credentials.get(name))
+            entry = {
+                'name': name,
+                'section': section,
+                'nested': nested,
+                'own_keys': own_keys,
+                # The ~/.aws/credentials section the profile signs with, read only when needed.
+                'credentials': name if own_keys is not None else None,
+                'settings': dict(section),
+                'chain': [key]
+            }
+            if nested is not None:
+                parent = resolve(nested, stack + [key])
+                if 'error' in parent:
+                    entry = {'error': parent['error']}
+                else:
+                    entry['settings'] = parent['settings'] | section
+                    entry['chain'] = [key] + parent['chain']
+                    if own_keys is None and inherit_credentials and parent['own_keys'] is not None:
+                        entry['credentials'] = parent['name']
+            if 'error' not in entry:
+                entry['summary'] = summarize(entry['settings'])
+            entries[key] = entry
+            return entry
+
+        for key in sections:
+            resolve(key, [])
+        return {key: entries[key] for key in sections}
+
+    def __contains__(self, name):
+        return profile_key(name) in self.entries
+
+    def __getitem__(self, name):
+        key = profile_key(name)
+        if key not in self.entries:
+            raise KeyError(key)
+        entry = self.entries[key]
+        if 'error' in entry:
+            raise ValueError(f"Profile {name}: {entry['error']}")
+        return entry
+
+    def credentials(self, entry):
+        import configparser
+
+        if entry['credentials'] is None:
+            return None
+        credentials = configparser.ConfigParser()
+        credentials.read(self.credentials_path)
+        if not credentials.has_section(entry['credentials']):
+            return None
+        return dict(credentials[entry['credentials']])
+
+    def nested(self, entry):
+        if entry['nested'] is None:
+            return None
+        return self.entries[entry['nested']]
+
+    def profiles(self):
+        return [key[len("profile "):] for key in self.entries if key.startswith("profile ")]
+
+    def summaries(self):
+        for key, entry in self.entries.items():
+            if key.startswith("profile "):
+                yield key[len("profile "):], entry.get('summary', ERROR_SUMMARY)
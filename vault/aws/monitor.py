@@ -0,0 +1,55 @@
+import threading
+from os.path import expanduser
+
+from vault.aws.cfg import AWSShellInit, AwsConfigReader
+from vault.trace import event
+from vault.watch import watcher
+
+
+class ConfigMonitor(object):
+    # Keeps the reader of a resident process (serve, exec --supervise) in step with the files:
+    # a change to the config or credentials recompiles the affected profiles only and hands
+    # their names to the reader's listeners; an edited selection in ~/.aws/pyvault is carried
+    # over to the files sourced by the shells.
+
+    def __init__(self, reader: AwsConfigReader, pyvault_config="~/.aws/pyvault"):
+        self.reader = reader
+        self.pyvault_config = expanduser(pyvault_config)
+        self.watcher = watcher([reader.index.config_path, reader.index.credentials_path, self.pyvault_config])
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                changed = self.watcher.wait(timeout=1)
+                if changed:
+                    self.changed(changed)
+        finally:
+            self.watcher.close()
+
+    def changed(self, paths):
+        try:
+            if paths - {self.pyvault_config}:
+                names = self.reader.refresh()
+                event("config.reload", profiles=len(names))
+            if self.pyvault_config in paths:
+                self.selected()
+        except Exception as e:
+            # Half-written or broken files: the next save triggers another attempt.
+            event("config.reload", error=str(e))
+
+    def selected(self):
+        from vault.aws.shellstate import ShellState
+
+        shell = AWSShellInit(self.pyvault_config)
+        selected, state = shell.shell_get(), ShellState()
+        current = state.read()
+        if selected is not None and (current is None or current['profile'] != selected):
+            state.write(selected, shell.expiration(selected))
@@ -0,0 +1,160 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vault.aws.auth import Auth
+from vault.aws.clients import ClientFactory, default_factory
+from vault.aws.tokens import TokenStore, token_store
+from vault.trace import event, span
+
+# A profile is hot with at least PREWARM_MIN_USES uses over the last PREWARM_WINDOW seconds;
+# the others are left to refresh when they are next used.
+PREWARM_MIN_USES = 3
+PREWARM_WINDOW = 8 * 3600
+# Renewals started per second, and how many may go at once after a quiet spell.
+PREWARM_RATE = 1.0
+PREWARM_BURST = 4
+# Bounds of the scheduler's sleep between two looks at the cache.
+MIN_SLEEP = 5
+MAX_SLEEP = 600
+# A profile that failed, or would have prompted, is left alone for this long.
+RETRY_DELAY = 900
+
+
+class RateLimiter(object):
+    # Token bucket on the scheduler's clock.
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Prewarmer(object):
+    # Renews the tokens of the hot profiles as they enter their refresh window, so the next
+    # command doesn't wait for STS. Profiles that would prompt for MFA or an SSO approval are
+    # never renewed from here. Time only comes from `clock` and `sleep`, which a test can fake.
+
+    def __init__(self, reader, store: TokenStore = None, jobs=4, rate=PREWARM_RATE, burst=PREWARM_BURST,
+                 lead=None, min_uses=PREWARM_MIN_USES, window=PREWARM_WINDOW, region=None,
+                 clock=time.time, sleep=None, auth_factory=None, clients: ClientFactory = None):
+        self.reader = reader
+        self.store = store or token_store()
+        self.jobs = jobs
+        self.limiter = RateLimiter(rate, burst, clock)
+        # Seconds ahead of the expiry; by default each profile's own refresh window.
+        self.lead = lead
+        self.min_uses = min_uses
+        self.window = window
+        self.region = region
+        self.clock = clock
+        self.retry = {}
+        self.stopped = threading.Event()
+        self.sleep = sleep or self.stopped.wait
+        self.clients = clients or default_factory
+        self.auth_factory = auth_factory or self.default_auth
+
+    def default_auth(self, profile):
+        return Auth(profile, region=self.region, background=True, clients=self.clients, prompt=False)
+
+    def hot(self):
+        now = self.clock()
+        usage = self.store.stats.usage(now)
+        counts = {name: len([t for t in uses if t >= now - self.window]) for name, uses in usage.items()}
+        names = [name for name, count in counts.items() if count >= self.min_uses and name in self.reader]
+        return sorted(names, key=lambda name: -usage[name][-1])
+
+    def renew_at(self, auth):
+        token = self.store.get(auth.profile.name)
+        if token is None:
+            return 0
+        return float(token['expiration']) - (auth.refresh_window if self.lead is None else self.lead)
+
+    def plan(self):
+        # (due now, seconds until the next one is)
+        now = self.clock()
+        due, upcoming = [], []
+        for name in self.hot():
+            try:
+                auth = self.auth_factory(self.reader[name])
+            except (KeyError, ValueError):
+                continue
+            at = max(self.renew_at(auth), self.retry.get(name, 0))
+            (due if at <= now else upcoming).append((at, name, auth))
+        due.sort(key=lambda item: item[0])
+        wait = min([at - now for at, _, _ in upcoming], default=MAX_SLEEP)
+        return [(name, auth) for _, name, auth in due], wait
+
+    def renew(self, name, auth):
+        try:
+            if auth.interactive():
+                return "skipped"
+            lock = auth.profile.lock()
+            if not lock.acquire(blocking=False):
+                return "busy"
+            try:
+                # Someone may have renewed it while this one was queued.
+                auth.profile.reload()
+                if self.renew_at(auth) > self.clock():
+                    return "fresh"
+                auth.renew()
+                return "renewed"
+            finally:
+                lock.release()
+        except Exception as e:
+            event("prewarm.failed", profile=name, error=str(e))
+            return "failed"
+
+    def run_once(self):
+        # Returns the status of every profile due, and how long to sleep until the next round.
+        with span("prewarm") as s:
+            self.reader.refresh(self.store)
+            self.store.reload()
+            due, wait = self.plan()
+            admitted = []
+            for name, auth in due:
+                if not self.limiter.take():
+                    break
+                admitted.append((name, auth))
+            results = {name: "deferred" for name, _ in due[len(admitted):]}
+            if admitted:
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    statuses = pool.map(lambda item: self.renew(*item), admitted)
+                    results |= dict(zip([name for name, _ in admitted], statuses))
+            for name, status in results.items():
+                if status in ("failed", "skipped"):
+                    self.retry[name] = self.clock() + RETRY_DELAY
+                else:
+                    self.retry.pop(name, None)
+            s.set(due=len(due), renewed=list(results.values()).count("renewed"))
+        if len(admitted) < len(due):
+            return results, self.limiter.delay()
+        return results, min(max(wait, MIN_SLEEP), MAX_SLEEP)
+
+    def run(self, report=None):
+        while not self.stopped.is_set():
+            results, wait = self.run_once()
+            if report is not None and results:
+                report(results)
+            self.sleep(wait)
+
+    def start(self, report=None):
+        threading.Thread(target=self.run, args=(report,), daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
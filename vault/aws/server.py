@@ -0,0 +1,206 @@
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlparse
+
+from vault.aws.auth import Auth
+from vault.aws.cfg import AwsConfigReader
+
+# Peers that stall in the TLS handshake or mid-request are dropped after this many seconds.
+REQUEST_TIMEOUT = 10
+
+
+class CredentialService(object):
+
+    def __init__(self, config_path='~/.aws/config', mfa_stdin=False, region=None, auth_factory=None):
+        self.reader = AwsConfigReader(config_path=config_path)
+        self.default_region = region
+        self.mfa_stdin = mfa_stdin
+        self.auth_factory = auth_factory or self.default_auth
+        self.profiles = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+        # Whoever refreshes the reader (the monitor, a prewarmer sharing it), cached profiles go.
+        self.reader.listeners.append(self.invalidate)
+
+    def default_auth(self, profile):
+        return Auth(profile, mfa_stdin=self.mfa_stdin, region=self.default_region, background=True)
+
+    def profile(self, name):
+        with self.lock:
+            if name not in self.profiles:
+                self.profiles[name] = self.reader[name]
+            return self.profiles[name]
+
+    def watch(self):
+        # Resident: follow edits of the config instead of serving what it said at startup.
+        from vault.aws.monitor import ConfigMonitor
+        return ConfigMonitor(self.reader).start()
+
+    def invalidate(self, names):
+        with self.lock:
+            for name in names:
+                self.profiles.pop(name, None)
+
+    def flight(self, name):
+        with self.lock:
+            return self.flights.setdefault(name, threading.Lock())
+
+    def region(self, name):
+        profile = self.profile(name)
+        if self.default_region is not None:
+            return self.default_region
+        return profile['region'] if 'region' in profile else None
+
+    def credentials(self, name):
+        profile = self.profile(name)
+        # Concurrent callers for the same profile queue up behind the first one, which
+        # refreshes the token; the rest are then answered from the in-memory cache.
+        with self.flight(name):
+            return self.auth_factory(profile).auth()
+
+
+class CredentialRequestHandler(BaseHTTPRequestHandler):
+    server_version = "pyvault"
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        token = self.headers.get("Authorization", "")
+        if not hmac.compare_digest(token.encode(), self.server.token.encode()):
+            return self.reply(401, {"message": "Invalid authorization token"})
+
+        name = unquote(urlparse(self.path).path.strip("/"))
+        if not name:
+            return self.reply(404, {"message": "No profile given"})
+        # Checked up front: a KeyError from further down is a broken profile, not a missing one.
+        if name not in self.server.service.reader:
+            return self.reply(404, {"message": f"No such profile: {name}"})
+        try:
+            credentials = self.server.service.credentials(name)
+        except Exception as e:
+            return self.reply(500, {"message": str(e)})
+        # Ttl and Region are for pyvault broker clients, SDKs ignore them.
+        self.reply(200, credentials.to_container_dict() | {
+            "Ttl": int(credentials.expiration - time.time()),
+            "Region": self.server.service.region(name)
+        })
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Peers on a unix socket have no address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+
+class CredentialServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for a fleet of clients connecting at once, the default backlog is 5.
+    request_queue_size = 128
+
+    def __init__(self, service: CredentialService, host="127.0.0.1", port=0, token=None, debug=False,
+                 tls_cert=None, tls_key=None):
+        ThreadingHTTPServer.__init__(self, (host, port), CredentialRequestHandler)
+        self.service = service
+        self.token = token or secrets.token_urlsafe(32)
+        self.debug = debug
+        self.scheme = "http"
+        self.tls = None
+        if tls_cert is not None:
+            import ssl
+
+            self.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls.load_cert_chain(tls_cert, tls_key)
+            self.scheme = "https"
+
+    def finish_request(self, request, client_address):
+        if self.tls is None:
+            return ThreadingHTTPServer.finish_request(self, request, client_address)
+        # The handshake runs here, on the connection's own thread: a peer that never sends a
+        # ClientHello only ever holds up itself.
+        request.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = self.tls.wrap_socket(request, server_side=True)
+        except OSError:
+            request.close()
+            return
+        try:
+            ThreadingHTTPServer.finish_request(self, request, client_address)
+        finally:
+            request.close()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"{self.scheme}://{host}:{port}"
+
+    def profile_url(self, name):
+        return f"{self.url}/{quote(name, safe='')}"
+
+    def environment(self, name) -> dict:
+        return {
+            "AWS_CONTAINER_CREDENTIALS_FULL_URI": self.profile_url(name),
+            "AWS_CONTAINER_AUTHORIZATION_TOKEN": self.token
+        }
+
+
+class UnixCredentialServer(socketserver.ThreadingUnixStreamServer):
+    # The same protocol on a unix socket, for brokers shared by the users of one host; the
+    # socket is only accessible to its owner unless its permissions are opened up.
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, service: CredentialService, path, token=None, debug=False, mode=0o600):
+        self.path = os.path.expanduser(path)
+        self.remove_stale()
+        socketserver.ThreadingUnixStreamServer.__init__(self, self.path, CredentialRequestHandler)
+        os.chmod(self.path, mode)
+        self.service = service
+        self.token = token or secrets.token_urlsafe(32)
+        self.debug = debug
+
+    def remove_stale(self):
+        # Only the socket of a broker that is gone is replaced, never a file or a live broker.
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise ValueError(f"{self.path} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise ValueError(f"A broker is already listening on {self.path}")
+
+    @property
+    def url(self):
+        return f"unix://{self.path}"
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
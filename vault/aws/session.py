@@ -0,0 +1,76 @@
+import threading
+from datetime import datetime, timezone
+
+from vault.aws.auth import Auth
+from vault.aws.cfg import AwsConfigReader
+from vault.aws.clients import ClientFactory, default_factory
+
+
+class ProfileCredentials(object):
+    # The refresh callback behind botocore's RefreshableCredentials. It goes through the same
+    # Auth as `pyvault exec`, so the token cache, its locks and single flight are shared with
+    # every CLI process on the host.
+
+    def __init__(self, profile_name, config_path='~/.aws/config', region=None, mfa_stdin=False,
+                 clients: ClientFactory = None):
+        self.name = profile_name
+        self.region = region
+        self.mfa_stdin = mfa_stdin
+        self.clients = clients or default_factory
+        self.reader = AwsConfigReader(config_path=config_path)
+        self.auth = self.make_auth()
+
+    def make_auth(self):
+        return Auth(self.reader[self.name], mfa_stdin=self.mfa_stdin, region=self.region, background=True,
+                    clients=self.clients)
+
+    def metadata(self):
+        # A new Auth each time re-reads the token file, picking up what other processes stored,
+        # and a profile edited in the meantime is resolved again.
+        self.reader.refresh()
+        self.auth = self.make_auth()
+        credentials = self.auth.auth()
+        return {
+            'access_key': credentials.aws_access_key_id,
+            'secret_key': credentials.aws_secret_access_key,
+            'token': credentials.aws_session_token,
+            'expiry_time': datetime.fromtimestamp(credentials.expiration, tz=timezone.utc).isoformat()
+        }
+
+    def refreshable(self):
+        from botocore.credentials import RefreshableCredentials
+
+        credentials = RefreshableCredentials.create_from_metadata(self.metadata(), self.metadata, method='pyvault')
+        # botocore asks again from 15 minutes before the expiry; match pyvault's own windows so
+        # it neither polls while only the cached token would come back nor holds on too long.
+        credentials._advisory_refresh_timeout = self.auth.refresh_window
+        credentials._mandatory_refresh_timeout = self.auth.expiry_skew
+        return credentials
+
+
+shared = {}
+shared_lock = threading.Lock()
+
+
+def refreshable_credentials(profile_name, config_path='~/.aws/config', region=None, mfa_stdin=False):
+    # One credentials object per profile and region: any number of sessions and clients built on
+    # it refresh once, together.
+    key = (profile_name, config_path, region)
+    with shared_lock:
+        if key not in shared:
+            shared[key] = ProfileCredentials(profile_name, config_path=config_path, region=region,
+                                             mfa_stdin=mfa_stdin).refreshable()
+        return shared[key]
+
+
+def boto3_session(profile_name, config_path='~/.aws/config', region=None, mfa_stdin=False):
+    import boto3
+    import botocore.session
+
+    credentials = refreshable_credentials(profile_name, config_path=config_path, region=region, mfa_stdin=mfa_stdin)
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = credentials
+    if region is None:
+        profile = AwsConfigReader(config_path=config_path)[profile_name]
+        region = profile['region'] if 'region' in profile else None
+    return boto3.Session(botocore_session=botocore_session, region_name=region)
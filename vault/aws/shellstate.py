@@ -0,0 +1,85 @@
+import json
+import os
+from os.path import expanduser
+
+from vault.files import atomic_write
+
+SHELLS = ("sh", "bash", "zsh", "fish")
+
+
+def sh_quote(value):
+    return "'" + str(value).replace("'", "'\\''") + "'"
+
+
+def fish_quote(value):
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def detect_shell():
+    shell = os.path.basename(os.environ.get("SHELL", "sh"))
+    return shell if shell in SHELLS else "sh"
+
+
+class ShellState(object):
+    # The selected profile, precompiled into files shells source directly: starting a shell or
+    # drawing a prompt never runs pyvault. PYVAULT_EXPIRATION is kept current whenever the
+    # selected profile's credentials are refreshed.
+
+    def __init__(self, path="~/.aws/pyvault.d"):
+        self.path = expanduser(path)
+
+    def file(self, shell):
+        return os.path.join(self.path, "profile.fish" if shell == "fish" else "profile.sh")
+
+    @property
+    def state_file(self):
+        return os.path.join(self.path, "state.json")
+
+    def read(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, profile, expiration=None):
+        variables = {
+            'AWS_PROFILE': profile,
+            'PYVAULT_PROFILE': profile,
+            'PYVAULT_EXPIRATION': '' if expiration is None else int(expiration)
+        }
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        sh = ["# Generated by `pyvault set`, do not edit"]
+        sh += [f"export {k}={sh_quote(v)}" for k, v in variables.items()]
+        fish = ["# Generated by `pyvault set`, do not edit"]
+        fish += [f"set -gx {k} {fish_quote(v)}" for k, v in variables.items()]
+        atomic_write(self.file("sh"), lambda f: f.write("\n".join(sh) + "\n"))
+        atomic_write(self.file("fish"), lambda f: f.write("\n".join(fish) + "\n"))
+        atomic_write(self.state_file, lambda f: json.dump({'profile': profile, 'expiration': expiration}, f))
+
+    def refreshed(self, profile, expiration):
+        state = self.read()
+        if state is not None and state['profile'] == profile and state['expiration'] != expiration:
+            self.write(profile, expiration)
+
+    def snippet(self, shell):
+        path = sh_quote(self.file(shell)) if shell != "fish" else fish_quote(self.file(shell))
+        if shell == "fish":
+            return "\n".join([
+                f"test -r {path}; and source {path}",
+                "function pyvault",
+                "    command pyvault $argv",
+                "    set -l code $status",
+                f"    test \"$argv[1]\" = set; and test -r {path}; and source {path}",
+                "    return $code",
+                "end"
+            ])
+        return "\n".join([
+            f"[ -r {path} ] && . {path}",
+            "pyvault() {",
+            "    command pyvault \"$@\"",
+            "    set -- $? \"$1\"",
+            f"    [ \"$2\" = set ] && [ -r {path} ] && . {path}",
+            "    return $1",
+            "}"
+        ])
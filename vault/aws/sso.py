@@ -0,0 +1,116 @@
+import json
+import os
+import time
+from os.path import expanduser
+
+from vault.files import FileLock, atomic_write
+
+# Cached OIDC tokens are not handed out when they are about to expire.
+TOKEN_EXPIRY_SKEW = 300
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sso_cache_key(profile):
+    if 'sso_session' in profile:
+        return f"session:{profile['sso_session']}"
+    return f"url:{profile['sso_start_url']}"
+
+
+class SSOTokenCache(object):
+
+    def __init__(self, key, path="~/.aws/sso/cache"):
+        import hashlib
+
+        self.key = key
+        name = hashlib.sha1(key.encode()).hexdigest()
+        self.path = os.path.join(expanduser(path), f"pyvault-{name}.json")
+        self.pending_path = os.path.join(expanduser(path), f"pyvault-{name}.pending.json")
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.data = {}
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+
+    def flush(self):
+        atomic_write(self.path, lambda f: json.dump(self.data, f))
+
+    def lock(self):
+        return FileLock(f"{self.path}.lock")
+
+    def registration(self):
+        if self.data.get('registrationExpiresAt', 0) > time.time() + TOKEN_EXPIRY_SKEW:
+            return {'clientId': self.data['clientId'], 'clientSecret': self.data['clientSecret']}
+        return None
+
+    def access_token(self):
+        if self.data.get('expiresAt', 0) > time.time() + TOKEN_EXPIRY_SKEW:
+            return {'accessToken': self.data['accessToken']}
+        return None
+
+    def refresh_token(self):
+        if self.registration() is None:
+            return None
+        return self.data.get('refreshToken')
+
+    def usable(self):
+        return self.access_token() is not None or self.refresh_token() is not None
+
+    def set_registration(self, client_creds):
+        self.data = {
+            'key': self.key,
+            'clientId': client_creds['clientId'],
+            'clientSecret': client_creds['clientSecret'],
+            'registrationExpiresAt': client_creds['clientSecretExpiresAt']
+        }
+        self.flush()
+
+    def set_token(self, token):
+        self.data['accessToken'] = token['accessToken']
+        self.data['expiresAt'] = time.time() + token['expiresIn']
+        if 'refreshToken' in token:
+            self.data['refreshToken'] = token['refreshToken']
+        self.flush()
+
+    def invalidate(self, refresh=False):
+        self.data.pop('accessToken', None)
+        self.data.pop('expiresAt', None)
+        if refresh:
+            self.data.pop('refreshToken', None)
+        self.flush()
+
+    # A device authorization waiting for approval in the browser, published so other processes
+    # wait for its outcome instead of starting one of their own. Only valid while unexpired.
+    def pending(self):
+        try:
+            with open(self.pending_path) as f:
+                pending = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if pending.get('expiresAt', 0) <= time.time():
+            return None
+        return pending
+
+    def set_pending(self, device_creds, owner=None):
+        pending = device_creds | {'owner': owner or os.getpid()}
+        atomic_write(self.pending_path, lambda f: json.dump(pending, f))
+        return pending
+
+    def clear_pending(self):
+        try:
+            os.unlink(self.pending_path)
+        except FileNotFoundError:
+            pass
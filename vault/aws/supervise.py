@@ -0,0 +1,87 @@
+import signal
+import threading
+import time
+
+from vault.aws.env import AwsEnv
+from vault.aws.server import CredentialServer, CredentialService
+from vault.executor import Executor
+
+# Bounds of the keeper's sleep between two looks at the credentials.
+MIN_CHECK_INTERVAL = 5
+MAX_CHECK_INTERVAL = 300
+
+
+class ContainerEnv(AwsEnv):
+    # Instead of static keys the child gets the container-credentials endpoint of the embedded
+    # server; SDKs fetch again from it by themselves before what they hold expires.
+
+    def __init__(self, server: CredentialServer, profile, credentials, region=None):
+        AwsEnv.__init__(self, profile, credentials, region=region)
+        self.server = server
+
+    def setup(self) -> dict:
+        environments = self.server.environment(self.profile_details.name)
+        if self.region is not None:
+            environments["AWS_DEFAULT_REGION"] = self.region
+            environments["AWS_REGION"] = self.region
+        return environments
+
+    def cleanup(self) -> list:
+        return AwsEnv.cleanup(self) + [
+            "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI",
+            "AWS_CONTAINER_CREDENTIALS_FULL_URI",
+            "AWS_CONTAINER_AUTHORIZATION_TOKEN",
+            "AWS_CONTAINER_AUTHORIZATION_TOKEN_FILE"
+        ]
+
+
+class Supervisor(object):
+    # pyvault stays the parent of the command: a keeper thread renews the credentials ahead of
+    # their expiry and the embedded server always answers with the current ones.
+
+    def __init__(self, service: CredentialService, profile_name, region=None):
+        self.service = service
+        self.name = profile_name
+        self.region = region
+        self.server = CredentialServer(service)
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    def next_check(self, credentials):
+        auth = self.service.auth_factory(self.service.profile(self.name))
+        wait = credentials.expiration - auth.refresh_window - time.time()
+        return min(max(wait, MIN_CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+    def keep_fresh(self):
+        while not self.stopped.is_set():
+            try:
+                # Inside the refresh window this renews in the background; past the hard
+                # limit it blocks until new credentials are stored.
+                wait = self.next_check(self.service.credentials(self.name))
+            except Exception:
+                wait = MIN_CHECK_INTERVAL
+            self.stopped.wait(wait)
+
+    def run(self, *arguments):
+        credentials = self.service.credentials(self.name)
+        self.monitor = self.service.watch()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.keep_fresh, daemon=True).start()
+        env = ContainerEnv(self.server, self.service.profile(self.name), credentials, region=self.region)
+        proc = Executor(env, credentials).spawn(*arguments)
+
+        def _forward(signum, frame):
+            proc.send_signal(signum)
+
+        # The terminal delivers ^C to the child itself, pyvault just waits for it to exit.
+        previous = {signal.SIGINT: signal.signal(signal.SIGINT, signal.SIG_IGN)}
+        previous |= {s: signal.signal(s, _forward) for s in (signal.SIGTERM, signal.SIGHUP)}
+        try:
+            return proc.wait()
+        finally:
+            for s, handler in previous.items():
+                signal.signal(s, handler)
+            self.stopped.set()
+            self.monitor.stop()
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,358 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from os.path import expanduser
+
+from vault.files import FileLock, atomic_write
+
+# How often the file store sweeps out expired entries.
+COMPACT_INTERVAL = 3600
+# Least recently used entries are evicted beyond this many (PYVAULT_TOKEN_CACHE_MAX). Only a put()
+# adding an entry checks; MFA sessions and sign-in tokens (names with a ':') are left to compaction.
+MAX_ENTRIES = 1000
+# Counters of profiles unused for this long are dropped when the logs are folded.
+STATS_RETENTION = 30 * 86400
+EVENTS = {'hit': b'h', 'coalesced': b'c', 'miss': b'm', 'refresh': b'r'}
+# Lookups made for a command are uses of the profile, refreshes done ahead of time are not.
+# Their timestamps are kept for USAGE_WINDOW, the USAGE_HISTORY latest ones per profile.
+USAGE_EVENTS = ('hit', 'coalesced', 'miss')
+USAGE_WINDOW = 7 * 86400
+USAGE_HISTORY = 256
+
+
+# Profile names as file names. Cheaper than urllib.parse.quote, which costs the fast path an import.
+def escape(name):
+    return name.replace("%", "%25").replace("/", "%2F")
+
+
+def unescape(name):
+    return name.replace("%2F", "/").replace("%25", "%")
+
+
+class CacheStats(object):
+    # Every cache lookup appends a single byte to its profile's log, and a use its 4-byte timestamp
+    # to the .use one: no lock and no read on the hot path. fold() sums the logs up into
+    # counts.json from time to time.
+
+    def __init__(self, path):
+        self.path = expanduser(path)
+
+    def log(self, name):
+        return os.path.join(self.path, escape(name) + ".log")
+
+    def usage_log(self, name):
+        return os.path.join(self.path, escape(name) + ".use")
+
+    @property
+    def counts_file(self):
+        return os.path.join(self.path, "counts.json")
+
+    def append(self, path, data):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        except FileNotFoundError:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def record(self, name, event, now=None):
+        self.append(self.log(name), EVENTS[event])
+        if event in USAGE_EVENTS:
+            self.append(self.usage_log(name), int(now or time.time()).to_bytes(4, 'little'))
+
+    def folded(self):
+        try:
+            with open(self.counts_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def add(self, counters, name, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = counters.setdefault(name, {event: 0 for event in EVENTS} | {'last_used': 0})
+        for event, code in EVENTS.items():
+            entry[event] += data.count(code)
+        entry['last_used'] = max(entry['last_used'], os.stat(path).st_mtime)
+
+    def add_uses(self, counters, name, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = counters.setdefault(name, {event: 0 for event in EVENTS} | {'last_used': 0})
+        uses = entry.get('uses', []) + [int.from_bytes(data[i:i + 4], 'little') for i in range(0, len(data) - 3, 4)]
+        entry['uses'] = sorted(uses)[-USAGE_HISTORY:]
+
+    def logs(self):
+        # (profile, path, reader) of every log not folded yet.
+        try:
+            files = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        readers = {".log": self.add, ".use": self.add_uses}
+        return [(unescape(f[:-4]), os.path.join(self.path, f), readers[f[-4:]]) for f in files if f[-4:] in readers]
+
+    def counters(self) -> dict:
+        counters = self.folded()
+        for name, path, add in self.logs():
+            try:
+                add(counters, name, path)
+            except OSError:
+                pass
+        return counters
+
+    def usage(self, now=None) -> dict:
+        cutoff = (now or time.time()) - USAGE_WINDOW
+        usage = {}
+        for name, c in self.counters().items():
+            uses = [t for t in c.get('uses', []) if t >= cutoff]
+            if uses:
+                usage[name] = uses
+        return usage
+
+    def fold(self):
+        if not os.path.isdir(self.path):
+            return
+        with FileLock(os.path.join(self.path, "counts.lock")):
+            counters = self.folded()
+            for name, path, add in self.logs():
+                # Renamed first: events recorded meanwhile start a new log instead of getting lost.
+                folding = path + ".folding"
+                try:
+                    os.rename(path, folding)
+                    add(counters, name, folding)
+                    os.unlink(folding)
+                except OSError:
+                    pass
+            now = time.time()
+            counters = {name: c for name, c in counters.items() if c['last_used'] >= now - STATS_RETENTION}
+            for c in counters.values():
+                c['uses'] = [t for t in c.get('uses', []) if t >= now - USAGE_WINDOW]
+            atomic_write(self.counts_file, lambda f: json.dump(counters, f))
+
+
+class TokenStore(ABC):
+    stats: CacheStats = None
+    max_entries = MAX_ENTRIES
+
+    @abstractmethod
+    def get(self, name):
+        pass
+
+    @abstractmethod
+    def put(self, name, token: dict):
+        pass
+
+    @abstractmethod
+    def delete(self, name):
+        pass
+
+    @abstractmethod
+    def names(self) -> list:
+        pass
+
+    @abstractmethod
+    def lock(self, name) -> FileLock:
+        pass
+
+    def reload(self):
+        pass
+
+    def record(self, name, event):
+        self.stats.record(name, event)
+
+    def lock_names(self) -> list:
+        return []
+
+    def stored(self, name):
+        return 0
+
+    def discard(self, name, blocking=True, stale=None):
+        # Drops the entry and its lock file under the profile's lock, so a token stored by a
+        # concurrent refresh is never lost; `stale` decides on the entry as it is then.
+        lock = self.lock(name)
+        if not lock.acquire(blocking=blocking):
+            return False
+        try:
+            self.reload()
+            if stale is not None and not stale(self.get(name)):
+                return False
+            self.delete(name)
+            lock.remove()
+            return True
+        finally:
+            lock.release()
+
+    def compact(self):
+        # Entries being refreshed right now are left for the next round, waiting on their lock
+        # from here could deadlock with a put() that is evicting.
+        now = time.time()
+        removed = []
+        for name in self.names():
+            token = self.get(name)
+            if token is not None and float(token['expiration']) < now and \
+                    self.discard(name, blocking=False, stale=lambda t: t is not None and float(t['expiration']) < now):
+                removed.append(name)
+        # Locks of profiles that never got, or no longer have, a token.
+        for name in self.lock_names():
+            if self.get(name) is None:
+                self.discard(name, blocking=False, stale=lambda t: t is None)
+        self.stats.fold()
+        return removed
+
+    def evict(self, keep=None):
+        names = self.names()
+        excess = len(names) - self.max_entries
+        if excess <= 0:
+            return []
+        names = [name for name in names if name != keep and ':' not in name]
+        counters = self.stats.counters()
+        # Entries stored but never looked up through the stats count from when they were stored.
+        names.sort(key=lambda name: max(counters.get(name, {}).get('last_used', 0), self.stored(name)))
+        return [name for name in names[:excess] if self.discard(name, blocking=False)]
+
+
+class IniTokenStore(TokenStore):
+    # The original single-file ~/.aws/tokens layout, every write rewrites the whole file.
+
+    def __init__(self, path="~/.aws/tokens", max_entries=MAX_ENTRIES):
+        self.path = expanduser(path)
+        self.stats = CacheStats(f"{self.path}.stats")
+        self.max_entries = max_entries
+        self.reload()
+
+    def reload(self):
+        import configparser
+
+        self.parser = configparser.ConfigParser()
+        self.parser.read(self.path)
+
+    def get(self, name):
+        if self.parser.has_section(name):
+            return dict(self.parser[name])
+        return None
+
+    def update(self, fn):
+        # Other processes may have stored their own profiles since we read the file:
+        # apply our change to the latest contents instead of overwriting them.
+        with FileLock(f"{self.path}.lock"):
+            self.reload()
+            fn(self.parser)
+            atomic_write(self.path, self.parser.write)
+
+    def put(self, name, token: dict):
+        added = []
+
+        def _put(parser):
+            now = time.time()
+            added[:] = [not parser.has_section(name)]
+            for section in parser.sections():
+                if float(parser[section].get('expiration', 0)) < now:
+                    parser.remove_section(section)
+            parser.read_dict({name: token})
+
+        self.update(_put)
+        if added[0]:
+            self.evict(keep=name)
+
+    def delete(self, name):
+        self.update(lambda parser: parser.remove_section(name))
+
+    def names(self) -> list:
+        return self.parser.sections()
+
+    def lock(self, name) -> FileLock:
+        return FileLock(f"{self.path}.locks/{escape(name)}.lock")
+
+    def lock_names(self) -> list:
+        try:
+            return [unescape(f[:-len(".lock")]) for f in os.listdir(f"{self.path}.locks") if f.endswith(".lock")]
+        except FileNotFoundError:
+            return []
+
+
+class FileTokenStore(TokenStore):
+    # One small JSON file per profile: reads and writes only ever touch that profile's file.
+
+    def __init__(self, path="~/.aws/tokens.d", legacy_path="~/.aws/tokens", max_entries=MAX_ENTRIES):
+        self.path = expanduser(path)
+        self.stats = CacheStats(os.path.join(self.path, ".stats"))
+        self.max_entries = max_entries
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            self.migrate(IniTokenStore(legacy_path))
+
+    def file(self, name, suffix=".json"):
+        return os.path.join(self.path, escape(name) + suffix)
+
+    def get(self, name):
+        try:
+            with open(self.file(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, name, token: dict):
+        added = not os.path.exists(self.file(name))
+        atomic_write(self.file(name), lambda f: json.dump(token, f))
+        self.maybe_compact()
+        if added:
+            self.evict(keep=name)
+
+    def delete(self, name):
+        try:
+            os.unlink(self.file(name))
+        except FileNotFoundError:
+            pass
+
+    def names(self) -> list:
+        return [unescape(f[:-len(".json")]) for f in os.listdir(self.path) if f.endswith(".json")]
+
+    def lock(self, name) -> FileLock:
+        return FileLock(self.file(name, ".lock"))
+
+    def lock_names(self) -> list:
+        return [unescape(f[:-len(".lock")]) for f in os.listdir(self.path) if f.endswith(".lock")]
+
+    def stored(self, name):
+        try:
+            return os.stat(self.file(name)).st_mtime
+        except FileNotFoundError:
+            return 0
+
+    def maybe_compact(self):
+        marker = os.path.join(self.path, ".compacted")
+        try:
+            if time.time() - os.stat(marker).st_mtime < COMPACT_INTERVAL:
+                return
+        except FileNotFoundError:
+            pass
+        with open(marker, "a"):
+            os.utime(marker)
+        self.compact()
+
+    def migrate(self, legacy: TokenStore):
+        now = time.time()
+        for name in legacy.names():
+            token = legacy.get(name)
+            if float(token.get('expiration', 0)) > now:
+                self.put(name, token)
+
+
+stores = {}
+
+
+def token_store(kind=None) -> TokenStore:
+    kind = kind or os.environ.get('PYVAULT_TOKEN_STORE', 'files')
+    if kind not in stores:
+        max_entries = int(os.environ.get('PYVAULT_TOKEN_CACHE_MAX', MAX_ENTRIES))
+        if kind == 'ini':
+            stores[kind] = IniTokenStore(max_entries=max_entries)
+        elif kind == 'files':
+            stores[kind] = FileTokenStore(max_entries=max_entries)
+        else:
+            raise ValueError(f"Unknown token store: {kind}")
+    return stores[kind]
@@ -0,0 +1,64 @@
+import fnmatch
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vault.aws.auth import Auth
+from vault.aws.clients import ClientFactory, default_factory
+
+
+def match_profiles(reader, patterns):
+    profiles = [name for name, _ in reader.summaries()]
+    matched = []
+    for pattern in patterns:
+        names = fnmatch.filter(profiles, pattern) if any(c in pattern for c in "*?[") else [pattern]
+        matched += [name for name in names if name not in matched]
+    return matched
+
+
+class WarmResult(object):
+
+    def __init__(self, profile, status, duration, credentials=None, error=None):
+        self.profile = profile
+        self.status = status
+        self.duration = duration
+        self.credentials = credentials
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Warmer(object):
+
+    def __init__(self, reader, jobs=8, mfa_stdin=False, region=None, auth_factory=None,
+                 clients: ClientFactory = None):
+        self.reader = reader
+        self.jobs = jobs
+        self.mfa_stdin = mfa_stdin
+        self.region = region
+        # Profiles signing with the same source identity share one client.
+        self.clients = clients or default_factory
+        self.auth_factory = auth_factory or self.default_auth
+
+    def default_auth(self, profile):
+        # Run from pool threads, where refresh-ahead must not fork.
+        return Auth(profile, mfa_stdin=self.mfa_stdin, region=self.region, background=True,
+                    clients=self.clients)
+
+    def warm_one(self, name):
+        started = time.perf_counter()
+        try:
+            auth = self.auth_factory(self.reader[name])
+            credentials = auth.fresh()
+            status = "cached"
+            if credentials is None:
+                credentials = auth.refresh(blocking=True)
+                status = "refreshed"
+            return WarmResult(name, status, time.perf_counter() - started, credentials=credentials)
+        except Exception as e:
+            return WarmResult(name, "failed", time.perf_counter() - started, error=e)
+
+    def warm(self, names) -> list:
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(self.warm_one, names))
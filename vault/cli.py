@@ -1,20 +1,25 @@
+import sys
 from functools import update_wrapper
 
 import click
-from pyfzf import FzfPrompt
 
 from vault.aws import auth
 from vault.aws.cfg import AwsConfigReader, AWSShellInit
 from vault.aws.env import AwsEnv
-from vault.config import Config
+from vault.config import Config, pass_config
 from vault.executor import ExecConfig, Executor
+from vault.trace import span, tracer
 from vault.version import version as ver
 
 
 @click.group(invoke_without_command=True)
 @click.option('--debug/--no-debug', default=False)
+@click.option('--trace', help="Write phase timings as JSON lines to stderr", default=False, is_flag=True)
+@click.option('--trace-file', help="Write phase timings as JSON lines to this file")
 @click.pass_context
-def cli(ctx, debug):
+def cli(ctx, debug, trace, trace_file):
+    if trace or trace_file:
+        tracer.enable(trace_file)
     ctx.obj = Config(debug)
 
 
@@ -25,11 +30,23 @@ def pass_exec_config(fn):
         @click.option("--region", help="AWS region to use")
         @click.option("--config", help="AWS config file", default="~/.aws/config")
         @click.option("--mfa-stdin", help="Read MFA code from stdin", default=False, is_flag=True)
-        def _fn(ctx, profile, config, mfa_stdin, region, *args, **kwargs):
-            with AwsConfigReader(config_path=config) as config_parser:
-                credentials = auth.Auth(config_parser[profile], mfa_stdin=mfa_stdin, region=region).auth()
-                env = AwsEnv(config_parser[profile], credentials, region=region)
-                obj = ExecConfig(profile, credentials, env, mfa_stdin, region)
+        @click.option("--broker", help="Get credentials from this pyvault broker", envvar="PYVAULT_BROKER")
+        @click.option("--broker-token", help="Broker authorization token", envvar="PYVAULT_BROKER_TOKEN")
+        @click.option("--broker-ca", help="CA bundle to verify an https broker", envvar="PYVAULT_BROKER_CA")
+        def _fn(ctx, profile, config, mfa_stdin, region, broker, broker_token, broker_ca, *args, **kwargs):
+            with span("exec_config", profile=profile):
+                with AwsConfigReader(config_path=config) as config_parser:
+                    if broker:
+                        from vault.aws.broker import BrokerAuth, BrokerClient
+
+                        broker_auth = BrokerAuth(profile, BrokerClient(broker, broker_token, ca_file=broker_ca),
+                                                 region=region)
+                        credentials = broker_auth.auth()
+                        env = AwsEnv(broker_auth.details(config_parser), credentials, region=region)
+                    else:
+                        credentials = auth.Auth(config_parser[profile], mfa_stdin=mfa_stdin, region=region).auth()
+                        env = AwsEnv(config_parser[profile], credentials, region=region)
+                    obj = ExecConfig(profile, credentials, env, mfa_stdin, region, config)
             return ctx.invoke(fn, obj, *args, **kwargs)
 
         return update_wrapper(_fn, fn)
@@ -39,50 +56,355 @@ def pass_exec_config(fn):
 
 @cli.command("list")
 @click.option("--config", help="AWS config file", default="~/.aws/config")
-def profiles_list(config):
-    def _dump_prov_profiles(prov, profiles):
-        click.echo("Provider: " + click.style(prov, fg="white", bold=True))
-        for _profile in profiles:
-            click.secho(f" {_profile}", fg="green")
+@click.option("--long", "-l", "long_format", help="Show account, role, region and cache state", default=False,
+              is_flag=True)
+def profiles_list(config, long_format):
+    from vault import picker
 
     with AwsConfigReader(config_path=config) as config_parser:
+        if long_format:
+            w = picker.widths(config_parser.summaries())
+            lines = [click.style(picker.header(w), fg="white", bold=True)]
+            lines += [picker.row(*p, w) for p in config_parser.annotated_profiles()]
+            click.echo("\n".join(lines))
+            return
+
+        def _dump_prov_profiles(prov, profiles):
+            lines = ["Provider: " + click.style(prov, fg="white", bold=True)]
+            lines += [click.style(f" {_profile}", fg="green") for _profile in profiles]
+            click.echo("\n".join(lines))
+
         config_parser.list_profiles(_dump_prov_profiles)
 
 
 @cli.command("exec")
+@click.option("--supervise", help="Stay resident and serve the command rotating credentials", default=False,
+              is_flag=True)
 @click.argument('arguments', nargs=-1, type=click.Path())
 @pass_exec_config
-def execute(exec_cfg: ExecConfig, arguments):
+def execute(exec_cfg: ExecConfig, arguments, supervise):
+    if supervise:
+        from vault.aws.server import CredentialService
+        from vault.aws.supervise import Supervisor
+
+        if not arguments:
+            raise click.UsageError("--supervise needs a command to run")
+        service = CredentialService(config_path=exec_cfg.config, mfa_stdin=exec_cfg.mfa_stdin, region=exec_cfg.region)
+        sys.exit(Supervisor(service, exec_cfg.profile, region=exec_cfg.region).run(*arguments))
     executor = Executor(exec_cfg.env, exec_cfg.credentials)
     executor.invoke(*arguments)
 
 
+@cli.command("exec-many", context_settings={"ignore_unknown_options": True})
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--region", help="AWS region to use")
+@click.option("--mfa-stdin", help="Read MFA code from stdin", default=False, is_flag=True)
+@click.option("--profile", "-p", "profiles", help="Profile or glob, may be repeated", multiple=True, required=True)
+@click.option("--jobs", help="Profiles run in parallel", default=8, type=int)
+@click.option("--collect", help="Print each profile's output in one block once it finishes", default=False,
+              is_flag=True)
+@click.argument("arguments", nargs=-1, required=True, type=click.UNPROCESSED)
+def execute_many(config, region, mfa_stdin, profiles, jobs, collect, arguments):
+    from vault.aws.fanout import FanOut, ProfileOutput
+    from vault.aws.warm import match_profiles
+
+    with AwsConfigReader(config_path=config) as config_parser:
+        names = match_profiles(config_parser, profiles)
+        if not names:
+            click.secho("No profiles matched", fg="red", err=True)
+            sys.exit(1)
+        output = ProfileOutput(max(len(n) for n in names), collect=collect)
+        results = FanOut(config_parser, arguments, jobs=jobs, mfa_stdin=mfa_stdin, region=region,
+                         output=output).run(names)
+
+    width = max([len(r.profile) for r in results] + [len("PROFILE")])
+    click.secho(f"{'PROFILE':<{width}}  {'EXIT':>4}  {'AUTH':>7}  {'RUN':>7}", fg="white", bold=True, err=True)
+    for r in results:
+        status = str(r.returncode) if r.error is None else "-"
+        line = f"{r.profile:<{width}}  " + click.style(f"{status:>4}", fg="green" if r.ok else "red") + \
+            f"  {r.resolve_time:>6.2f}s  {r.run_time:>6.2f}s"
+        if r.error is not None:
+            line += f"  {r.error}"
+        click.echo(line, err=True)
+    failed = [r for r in results if not r.ok]
+    if failed:
+        sys.exit(max(r.exit_code for r in failed))
+
+
+@cli.command("login")
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--region", help="AWS region to use")
+@click.option("--mfa-stdin", help="Read MFA code from stdin", default=False, is_flag=True)
+@click.option("--jobs", help="Profiles signed in parallel", default=8, type=int)
+@click.option("--duration", help="Console session duration in seconds", type=int)
+@click.option("--destination", help="Console URL to land on instead of the home page")
+@click.option("--no-browser", help="Only print the sign-in URLs", default=False, is_flag=True)
+@click.argument("profiles", nargs=-1, required=True)
+def login(config, region, mfa_stdin, jobs, duration, destination, no_browser, profiles):
+    import webbrowser
+    from concurrent.futures import ThreadPoolExecutor
+    from vault.aws.console import ConsoleLogin, SharedSession
+    from vault.aws.warm import Warmer, match_profiles
+
+    http = SharedSession()
+
+    with AwsConfigReader(config_path=config) as config_parser:
+        names = match_profiles(config_parser, profiles)
+        warmer = Warmer(config_parser, jobs=jobs, mfa_stdin=mfa_stdin, region=region)
+
+        def _url(name):
+            resolved = warmer.warm_one(name)
+            if not resolved.ok:
+                return name, None, resolved.error
+            profile_region = region or config_parser[name]['region']
+            try:
+                console = ConsoleLogin(name, resolved.credentials, profile_region, session_duration=duration, http=http)
+                return name, console.url(destination), None
+            except Exception as e:
+                return name, None, e
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_url, names))
+
+    for name, url, error in results:
+        if error is not None:
+            click.echo(click.style(name, fg="red", bold=True) + f": {error}", err=True)
+        elif no_browser:
+            click.echo(click.style(name, fg="white", bold=True) + f": {url}")
+        else:
+            webbrowser.open_new_tab(url)
+            click.echo("Console opened for " + click.style(name, fg="white", bold=True))
+    if any(error is not None for _, _, error in results):
+        sys.exit(1)
+
+
+@cli.command("serve")
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--region", help="AWS region to use")
+@click.option("--mfa-stdin", help="Read MFA code from stdin", default=False, is_flag=True)
+@click.option("--host", help="Address to listen on", default="127.0.0.1")
+@click.option("--port", help="Port to listen on (0 picks a free one)", default=0, type=int)
+@click.option("--socket", "socket_path", help="Listen on this unix socket instead of TCP")
+@click.option("--token", help="Authorization token clients must send", envvar="PYVAULT_SERVE_TOKEN")
+@click.option("--tls-cert", help="Serve https with this certificate (PEM)", type=click.Path(exists=True))
+@click.option("--tls-key", help="Private key of --tls-cert", type=click.Path(exists=True))
+@click.option("--prewarm", help="Renew the hot profiles ahead of their expiry", default=False, is_flag=True)
+@pass_config
+def serve(cfg: Config, config, region, mfa_stdin, host, port, socket_path, token, tls_cert, tls_key, prewarm):
+    from vault.aws.server import CredentialServer, CredentialService, UnixCredentialServer
+
+    service = CredentialService(config_path=config, mfa_stdin=mfa_stdin, region=region)
+    if socket_path:
+        try:
+            server = UnixCredentialServer(service, socket_path, token=token, debug=cfg.debug)
+        except ValueError as e:
+            click.secho(str(e), fg="red", err=True)
+            sys.exit(1)
+    else:
+        server = CredentialServer(service, host=host, port=port, token=token, debug=cfg.debug,
+                                  tls_cert=tls_cert, tls_key=tls_key)
+    click.echo(f"export AWS_CONTAINER_AUTHORIZATION_TOKEN={server.token}")
+    if socket_path:
+        click.echo(f"# export PYVAULT_BROKER={server.url} PYVAULT_BROKER_TOKEN={server.token}")
+    else:
+        click.echo(f"# export AWS_CONTAINER_CREDENTIALS_FULL_URI={server.url}/<profile>")
+        click.echo(f"# export PYVAULT_BROKER={server.url} PYVAULT_BROKER_TOKEN={server.token}")
+    sys.stdout.flush()
+    service.watch()
+    if prewarm:
+        from vault.aws.prewarm import Prewarmer
+        Prewarmer(service.reader, region=region).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.command("warm")
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--region", help="AWS region to use")
+@click.option("--mfa-stdin", help="Read MFA code from stdin", default=False, is_flag=True)
+@click.option("--jobs", help="Profiles resolved in parallel", default=8, type=int)
+@click.argument("profiles", nargs=-1, required=True)
+def warm(config, region, mfa_stdin, jobs, profiles):
+    from vault.aws.warm import Warmer, match_profiles
+
+    with AwsConfigReader(config_path=config) as config_parser:
+        names = match_profiles(config_parser, profiles)
+        results = Warmer(config_parser, jobs=jobs, mfa_stdin=mfa_stdin, region=region).warm(names)
+
+    width = max([len(r.profile) for r in results] + [len("PROFILE")])
+    click.secho(f"{'PROFILE':<{width}}  {'STATUS':<9}  {'TIME':>7}  EXPIRES", fg="white", bold=True)
+    for r in results:
+        details = r.credentials.expires_at() if r.ok else str(r.error)
+        click.echo(f"{r.profile:<{width}}  " +
+                   click.style(f"{r.status:<9}", fg="green" if r.ok else "red") +
+                   f"  {r.duration:>6.2f}s  {details}")
+    if not all(r.ok for r in results):
+        sys.exit(1)
+
+
+@cli.command("prewarm")
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--region", help="AWS region to use")
+@click.option("--jobs", help="Profiles renewed in parallel", default=4, type=int)
+@click.option("--rate", help="Renewals started per second at most", default=1.0, type=float)
+@click.option("--lead", help="Seconds ahead of the expiry to renew, the profile's refresh window by default",
+              type=int)
+@click.option("--min-uses", help="Uses within --window that make a profile hot", default=3, type=int)
+@click.option("--window", help="Seconds of usage history looked at", default=8 * 3600, type=int)
+@click.option("--once", help="Renew what is due now and exit", default=False, is_flag=True)
+def prewarm(config, region, jobs, rate, lead, min_uses, window, once):
+    import time
+    from vault.aws.prewarm import Prewarmer
+
+    def report(results):
+        stamp = time.strftime("%H:%M:%S")
+        for name, status in results.items():
+            click.echo(f"{stamp}  {name}  " + click.style(status, fg="red" if status == "failed" else "green"))
+
+    prewarmer = Prewarmer(AwsConfigReader(config_path=config), jobs=jobs, rate=rate, lead=lead,
+                          min_uses=min_uses, window=window, region=region)
+    if once:
+        results, _ = prewarmer.run_once()
+        report(results)
+        if "failed" in results.values():
+            sys.exit(1)
+        return
+    try:
+        prewarmer.run(report)
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.group("sso")
+def sso():
+    pass
+
+
+@sso.command("discover")
+@click.option("--config", help="AWS config file", default="~/.aws/config")
+@click.option("--source", "sources", help="sso-session (or SSO profile) to discover, all by default", multiple=True)
+@click.option("--ttl", help="Re-list the roles of accounts older than this many seconds", default=86400, type=int)
+@click.option("--jobs", help="Accounts listed in parallel", default=16, type=int)
+@click.option("--force", help="Re-list the roles of every account", default=False, is_flag=True)
+def sso_discover(config, sources, ttl, jobs, force):
+    from vault.aws.auth import SSORoleProvider
+
+    with AwsConfigReader(config_path=config) as config_parser:
+        catalogs = [c for c in config_parser.catalogs if not sources or c.source in sources]
+        missing = set(sources) - {c.source for c in catalogs}
+        if missing:
+            click.secho(f"No SSO login configured for: {', '.join(sorted(missing))}", fg="red", err=True)
+            sys.exit(1)
+        for catalog in catalogs:
+            provider = SSORoleProvider(catalog.settings, region=catalog.region)
+            fetched = catalog.discover(provider, ttl=ttl, jobs=jobs, force=force)
+            click.echo(click.style(catalog.source, fg="white", bold=True) +
+                       f": {len(catalog.accounts)} accounts, {len(catalog.profiles())} roles"
+                       f" ({fetched} accounts refreshed)")
+
+
+@cli.group("cache")
+def cache():
+    pass
+
+
+@cache.command("stats")
+def cache_stats():
+    import time
+    from vault.aws.tokens import token_store
+
+    store = token_store()
+    counters = store.stats.counters()
+    now = time.time()
+    names = sorted(set(store.names()) | set(counters))
+    width = max([len(n) for n in names] + [len("PROFILE")])
+    click.secho(f"{'PROFILE':<{width}}  {'TTL':>8}  {'HITS':>6}  {'MISSES':>6}  {'REFRESH':>7}  {'HIT%':>5}",
+                fg="white", bold=True)
+    entries = expired = 0
+    totals = {'hit': 0, 'coalesced': 0, 'miss': 0, 'refresh': 0}
+    for name in names:
+        token = store.get(name)
+        if token is None:
+            ttl = click.style(f"{'-':>8}", fg="white")
+        else:
+            entries += 1
+            left = float(token['expiration']) - now
+            expired += left <= 0
+            ttl = click.style(f"{int(left // 60):>7}m", fg="green") if left > 0 else \
+                click.style(f"{'expired':>8}", fg="red")
+        c = counters.get(name, {})
+        for k in totals:
+            totals[k] += c.get(k, 0)
+        hits = c.get('hit', 0) + c.get('coalesced', 0)
+        lookups = hits + c.get('miss', 0)
+        rate = f"{100 * hits / lookups:.0f}" if lookups else "-"
+        click.echo(f"{name:<{width}}  {ttl}  {hits:>6}  {c.get('miss', 0):>6}  {c.get('refresh', 0):>7}  {rate:>5}")
+    hits = totals['hit'] + totals['coalesced']
+    lookups = hits + totals['miss']
+    rate = f"{100 * hits / lookups:.1f}%" if lookups else "-"
+    click.echo(f"{entries} entries ({expired} expired, limit {store.max_entries}), "
+               f"{hits} hits / {totals['miss']} misses / {totals['refresh']} refreshes, hit rate {rate}")
+
+
+@cache.command("prune")
+def cache_prune():
+    from vault.aws.tokens import token_store
+
+    store = token_store()
+    removed = store.compact()
+    evicted = store.evict()
+    click.echo(f"Removed {len(removed)} expired and evicted {len(evicted)} least recently used entries")
+
+
+@cache.command("invalidate")
+@click.option("--all", "everything", help="Drop every cached entry", default=False, is_flag=True)
+@click.argument("profiles", nargs=-1)
+def cache_invalidate(everything, profiles):
+    import fnmatch
+    from vault.aws.tokens import token_store
+
+    if not everything and not profiles:
+        raise click.UsageError("Give profiles (globs allowed) or --all")
+    store = token_store()
+    names = store.names()
+    matched = names if everything else [n for n in names if any(fnmatch.fnmatchcase(n, p) for p in profiles)]
+    for name in matched:
+        store.discard(name)
+    click.echo(f"Invalidated {len(matched)} entries")
+
+
 @cli.command("init")
 @click.option("--pyvault-config", help="pyvault config file", default="~/.aws/pyvault")
-def execute(pyvault_config):
-    AWSShellInit(pyvault_config).shell_init()
+@click.option("--shell", help="Shell to emit the snippet for, $SHELL by default",
+              type=click.Choice(["sh", "bash", "zsh", "fish"]))
+def execute(pyvault_config, shell):
+    AWSShellInit(pyvault_config).shell_init(shell)
 
 
 @cli.command("set")
 @click.option("--config", help="AWS config file", default="~/.aws/config")
 @click.option("--pyvault-config", help="pyvault config file", default="~/.aws/pyvault")
 def set_profile(config, pyvault_config):
-    profiles = []
-
-    def _collect_prov_profiles(input, prov, ps):
-        for _p in ps:
-            input.append(_p)
+    from vault import picker
 
     with AwsConfigReader(config_path=config) as config_parser:
-        config_parser.list_profiles(lambda p1, p2: _collect_prov_profiles(profiles, p1, p2))
+        w = picker.widths(config_parser.summaries())
+        rows = (picker.row(*p, w) for p in config_parser.annotated_profiles())
+        try:
+            selection = picker.FzfPicker().prompt(rows, header_line=picker.header(w))
+        except ValueError as e:
+            click.secho(str(e), fg="red", err=True)
+            sys.exit(1)
 
-    fzf = FzfPrompt()
-    try:
-        selection = fzf.prompt(profiles)
-        AWSShellInit(pyvault_config).shell_set(selection[0])
-        click.echo("Profile selected: " + click.style(selection[0], fg="white", bold=True))
-    except Exception as e:
-        print(f"Cancelled. {e}")
+    if selection is None:
+        click.echo("Cancelled.")
+        return
+    AWSShellInit(pyvault_config).shell_set(selection)
+    click.echo("Profile selected: " + click.style(selection, fg="white", bold=True))
 
 
 @cli.command("get")
@@ -4,6 +4,7 @@ import sys
 from abc import ABC, abstractmethod
 
 from vault.auth import Credentials
+from vault.trace import event, span
 
 
 class ExecConfig(object):
@@ -12,12 +13,13 @@ class ExecConfig(object):
     __credentials = None
     __env = None
 
-    def __init__(self, profile, c: Credentials, e, mfa_stdin, region):
+    def __init__(self, profile, c: Credentials, e, mfa_stdin, region, config=None):
         self.__profile = profile
         self.__credentials = c
         self.__env = e
         self.__mfa_stdin = mfa_stdin
         self.__region = region
+        self.__config = config
 
     @property
     def profile(self):
@@ -39,6 +41,10 @@ class ExecConfig(object):
     def region(self):
         return self.__region
 
+    @property
+    def config(self):
+        return self.__config
+
 
 class ExecutorEnv(ABC):
 
@@ -63,8 +69,15 @@ class Executor(object):
         for env in new_env:
             self.env[env] = new_env[env]
 
+    def spawn(self, *arguments, **kwargs):
+        import subprocess
+
+        return subprocess.Popen(arguments, env=self.env, **kwargs)
+
     def invoke(self, *arguments):
         if len(arguments) > 0:
+            event("invoke", command=arguments[0])
             os.execvpe(arguments[0], args=arguments, env=self.env)
         else:
-            json.dump(self.credentials.to_dict(), sys.stdout)
+            with span("invoke", command=None):
+                json.dump(self.credentials.to_dict(), sys.stdout)
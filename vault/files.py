@@ -0,0 +1,78 @@
+import fcntl
+import os
+import threading
+from os.path import expanduser
+
+from vault.trace import span
+
+
+class FileLock(object):
+
+    def __init__(self, path):
+        self.path = expanduser(path)
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            # The previous holder may have removed the file while we waited: the lock we got is
+            # then on a dead inode, and whoever opens the path now gets a new one. Start over.
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    self.fd = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def remove(self):
+        # Only while holding it; waiters notice and move on to a new file.
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        with span("lock.wait", path=os.path.basename(self.path)):
+            self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def atomic_write(path, write, mode="w"):
+    # Readers either see the old file or the new one, never a partially written one.
+    path = expanduser(path)
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def file_stamp(path):
+    # Changes whenever the file is rewritten or replaced; None while it doesn't exist.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
@@ -0,0 +1,86 @@
+import os
+import sys
+
+from vault.trace import span, tracer
+
+
+def _parse_trace_args(argv):
+    # --trace / --trace-file are group options of the click CLI; honour them on the fast path too.
+    argv = list(argv)
+    while argv and argv[0].startswith("--trace"):
+        name, sep, value = argv.pop(0).partition("=")
+        if name == "--trace-file" and not sep and argv:
+            value = argv.pop(0)
+        tracer.enable(value if name == "--trace-file" else None)
+    return argv
+
+
+def _parse_exec_args(argv):
+    # Only the plain `credential_process` form is served here, anything else goes through click.
+    if len(argv) < 1 or argv[0] != "exec":
+        return None
+    opts = {"--profile": "local", "--config": "~/.aws/config", "--region": None}
+    args = argv[1:]
+    while args:
+        arg = args.pop(0)
+        name, sep, value = arg.partition("=")
+        if name not in opts:
+            return None
+        if not sep:
+            if not args:
+                return None
+            value = args.pop(0)
+        opts[name] = value
+    return opts
+
+
+def fast_exec(argv):
+    opts = _parse_exec_args(argv)
+    if opts is None:
+        return False
+
+    with span("import", module="vault.aws"):
+        from vault.aws.auth import Auth
+        from vault.aws.cfg import AwsConfigReader
+        from vault.aws.env import AwsEnv
+        from vault.executor import Executor
+
+    with AwsConfigReader(config_path=opts["--config"]) as config_parser:
+        if os.environ.get("PYVAULT_BROKER"):
+            from vault.aws.broker import BrokerAuth
+
+            broker_auth = BrokerAuth(opts["--profile"], region=opts["--region"])
+            credentials = broker_auth.cached()
+            if credentials is None:
+                return False
+            broker_auth.tokens.record("hit")
+            env = AwsEnv(broker_auth.details(config_parser), credentials, region=opts["--region"])
+        else:
+            try:
+                profile = config_parser[opts["--profile"]]
+                credentials = Auth(profile, region=opts["--region"]).cached()
+            except KeyError:
+                return False
+            if credentials is None:
+                return False
+            profile.record("hit")
+            env = AwsEnv(profile, credentials, region=opts["--region"])
+    Executor(env, credentials).invoke()
+    return True
+
+
+def main():
+    # Before the span is opened: with --trace, it is what records whether the cache served the call.
+    argv = _parse_trace_args(sys.argv[1:])
+    with span("fast_path") as s:
+        served = fast_exec(argv)
+        s.set(outcome="hit" if served else "fallback")
+    if served:
+        return
+    with span("import", module="vault.cli"):
+        from vault.cli import cli
+    cli()
+
+
+if __name__ == "__main__":
+    main()
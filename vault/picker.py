@@ -0,0 +1,67 @@
+import subprocess
+import time
+
+import click
+
+COLUMNS = ('kind', 'account', 'role', 'region')
+
+
+def cache_state(expiration, now=None):
+    if expiration is None:
+        return click.style("-", fg="white")
+    left = expiration - (now or time.time())
+    if left <= 0:
+        return click.style("expired", fg="red")
+    return click.style(f"valid {int(left // 60)}m", fg="green")
+
+
+def widths(summaries):
+    result = {'name': len("PROFILE")} | {c: len(c) for c in COLUMNS}
+    for name, summary in summaries:
+        result['name'] = max(result['name'], len(name))
+        for c in COLUMNS:
+            result[c] = max(result[c], len(summary[c]))
+    return result
+
+
+def header(w):
+    return f"{'PROFILE':<{w['name']}}  " + "  ".join(f"{c.upper():<{w[c]}}" for c in COLUMNS) + "  CACHE"
+
+
+def row(name, summary, expiration, w):
+    return f"{name:<{w['name']}}  " + "  ".join(f"{summary[c]:<{w[c]}}" for c in COLUMNS) + \
+        "  " + cache_state(expiration)
+
+
+class FzfPicker(object):
+    # Rows are written to fzf as they are produced instead of being collected first, so the
+    # finder shows up immediately and keeps filling in while the rest is being annotated.
+
+    def __init__(self, executable="fzf", options=()):
+        self.executable = executable
+        self.options = list(options)
+
+    def prompt(self, rows, header_line=None):
+        args = [self.executable, "--ansi", "--no-multi"] + self.options
+        if header_line is not None:
+            args.append(f"--header={header_line}")
+        try:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        except FileNotFoundError:
+            raise ValueError(f"{self.executable} not found, please install it")
+        try:
+            for line in rows:
+                proc.stdin.write(line + "\n")
+                proc.stdin.flush()
+        except BrokenPipeError:
+            # A selection was made (or fzf was closed) before every row was written.
+            pass
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        selection = proc.stdout.read()
+        proc.wait()
+        if proc.returncode != 0 or not selection.strip():
+            return None
+        return selection.split()[0]
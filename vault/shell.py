@@ -4,7 +4,7 @@ from abc import ABC, abstractmethod
 class ShellInit(ABC):
 
     @abstractmethod
-    def shell_init(self):
+    def shell_init(self, shell=None):
         pass
 
     @abstractmethod
@@ -0,0 +1,94 @@
+import json
+import os
+import sys
+import time
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = (time.perf_counter() - self.started) * 1000
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.emit(self.name, ms=round(elapsed, 3), **self.attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+class Tracer(object):
+    # Span timings as JSON lines on stderr or in a file; stdout stays reserved for the
+    # credentials of `credential_process`.
+
+    def __init__(self):
+        self.out = None
+        self.started = time.perf_counter()
+
+    @property
+    def enabled(self):
+        return self.out is not None
+
+    def enable(self, path=None):
+        if self.enabled:
+            return
+        self.out = sys.stderr if path in (None, '', '-', '1') else open(os.path.expanduser(path), 'a')
+
+    def emit(self, name, **attrs):
+        if self.out is None:
+            return
+        record = {
+            'span': name,
+            'at_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'pid': os.getpid()
+        } | attrs
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+
+    def span(self, name, **attrs):
+        if self.out is None:
+            return NoSpan()
+        return Span(self, name, attrs)
+
+
+tracer = Tracer()
+
+
+def configure(value):
+    # PYVAULT_TRACE: off for 0/false/no, a file only when it looks like a path, stderr otherwise.
+    value = value.strip()
+    if value.lower() in ('', '0', 'false', 'no', 'off'):
+        return
+    tracer.enable(value if os.sep in value or value.startswith('~') else None)
+
+
+configure(os.environ.get('PYVAULT_TRACE', ''))
+
+
+def span(name, **attrs):
+    return tracer.span(name, **attrs)
+
+
+def event(name, **attrs):
+    tracer.emit(name, **attrs)
@@ -0,0 +1,114 @@
+import os
+import select
+import struct
+from os.path import expanduser
+
+from vault.files import file_stamp
+
+# Bounds of the polling fallback and how long a burst of events is left to settle.
+POLL_INTERVAL = 2.0
+SETTLE_DELAY = 0.05
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Editors and atomic_write replace files by renaming over them: the directories are watched,
+# not the files, whose inode goes away with the first save.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+
+
+class PollingWatcher(object):
+
+    def __init__(self, paths, interval=POLL_INTERVAL):
+        self.paths = [expanduser(path) for path in paths]
+        self.interval = interval
+        self.stamps = {path: file_stamp(path) for path in self.paths}
+
+    def changed(self):
+        changed = set()
+        for path in self.paths:
+            stamp = file_stamp(path)
+            if stamp != self.stamps[path]:
+                self.stamps[path] = stamp
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        changed = self.changed()
+        if changed or timeout == 0:
+            return changed
+        select.select([], [], [], min(self.interval, timeout) if timeout is not None else self.interval)
+        return self.changed()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.paths = [expanduser(path) for path in paths]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        try:
+            for directory in {os.path.dirname(path) for path in self.paths}:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"Can't watch {directory}")
+                self.directories[wd] = directory
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def read(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + size].rstrip(b"\0")
+                offset += EVENT.size + size
+                path = os.path.join(self.directories.get(wd, ""), os.fsdecode(name))
+                if path in self.paths:
+                    changed.add(path)
+
+    def wait(self, timeout=None):
+        changed = set()
+        while not changed:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return changed
+            changed = self.read()
+            if changed:
+                # A save is often a write and a rename: take them as one change.
+                select.select([], [], [], SETTLE_DELAY)
+                changed |= self.read()
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watcher(paths):
+    # inotify on Linux; elsewhere, or once the watch limit is reached, the files are polled.
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError):
+        return PollingWatcher(paths)